@@ -1,80 +1,183 @@
-import logging, sys
 import json
-import threading
-import socket
+import time
 from consts import PaxosEvent
 from paxos_site import AbstractSiteDecorator
 
 class Acceptor(AbstractSiteDecorator):
-    def __init__(self, decorated_site):
+    def __init__(self, decorated_site, runtime, learner):
         super().__init__(decorated_site)
-        self.port = self.decorated_site.site_dict[self.decorated_site.site_id]["udp_start_port"] + 1
-        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+        self.runtime = runtime
+        self.learner = learner # Hears about commit indexes piggybacked on proposer messages
+        self.port = self.decorated_site.port(self.decorated_site.site_id, 1)
+        self.state = self.decorated_site.acceptor_state
+        self.tracer = self.decorated_site.tracer
 
-    def message_reciever(self):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        server_socket.bind(("", self.port))
-        while True:
-            try:
-                message, address = server_socket.recvfrom(32768)
-                decoded_message = json.loads(message.decode("utf-8"))
-                event = decoded_message["event"]
-                if event == PaxosEvent.PREPARE:
-                    res = self.promise(decoded_message["propose_num"], decoded_message["log_slot"])
-                elif event == PaxosEvent.ACCEPT:
-                    res = self.accept(decoded_message["propose_num"], decoded_message["propose_val"], decoded_message["log_slot"])
-                else:
-                    raise Exception("Unknown event for acceptor!")
-                server_socket.sendto(json.dumps(res).encode("utf-8"), address)
-            except Exception as e:
-                logging.info(f"Acceptor: Error while receiving: {e}")
+        # Read lease this acceptor granted. Nobody but the holder can become leader before it runs out.
+        # Grants aren't persisted, so after a restart the last known leader gets one full lease.
+        # With no leader known there's nobody to protect, and anyone may take over straight away.
+        config = self.decorated_site.config
+        self.lease_time = config["lease_ms"] / 1000 if config["leader_mode"] else 0
+        self.lease_holder = self.state.leader_id
+        self.lease_until = self.runtime.now() + self.lease_time if self.lease_holder != None else 0
+
+    def handle(self, decoded_message):
+        event = decoded_message["event"]
+        if event == PaxosEvent.PREPARE and decoded_message.get("all_slots"):
+            res = self.promise_all(decoded_message["propose_num"], decoded_message["log_slot"], decoded_message["origin"])
+        elif event == PaxosEvent.PREPARE:
+            res = self.promise(decoded_message["propose_num"], decoded_message["log_slot"])
+        elif event == PaxosEvent.ACCEPT:
+            res = self.accept(decoded_message["propose_num"], decoded_message["propose_val"], decoded_message["log_slot"])
+            if res["event"] == PaxosEvent.ACCEPTED and self.lease_time and self.is_leader_ballot(decoded_message["propose_num"], decoded_message.get("origin")):
+                self.grant_lease(decoded_message["origin"])
+                res["lease"] = True # Only these count towards the leader's lease
+        elif event == PaxosEvent.LEASE:
+            res = self.renew_lease(decoded_message["propose_num"], decoded_message["origin"])
+        else:
+            raise Exception("Unknown event for acceptor!")
+        if "commit_index" in decoded_message:
+            self.learner.note_commit_index(decoded_message["commit_index"], decoded_message["origin"])
+        res["watermark"] = self.decorated_site.cur_log_slot()
+        self.decorated_site.metrics.incr(f"acceptor.{PaxosEvent(res['event']).name.lower()}")
+        return self.reply_when_durable(res)
+
+    async def reply_when_durable(self, res):
+        # Whatever we just promised or accepted has to be on disk before the reply leaves
+        start = time.perf_counter()
+        await self.runtime.durable(self.decorated_site.wal, self.decorated_site.wal.lsn)
+        self.decorated_site.metrics.since("acceptor.durable_wait", start)
+        return res
+
+    def is_leader_ballot(self, propose_num, origin):
+        return origin != None and origin == self.state.leader_id and propose_num == self.state.promised
+
+    def lease_active(self):
+        return self.lease_time and self.runtime.now() < self.lease_until
+
+    def grant_lease(self, origin):
+        self.lease_holder = origin
+        self.lease_until = self.runtime.now() + self.lease_time
+
+    def renew_lease(self, propose_num, origin):
+        if self.lease_time and self.is_leader_ballot(propose_num, origin):
+            self.grant_lease(origin)
+            return {
+                "origin": self.decorated_site.site_id,
+                "event" : PaxosEvent.ACK
+                }
+        return {
+            "origin" : self.decorated_site.site_id,
+            "event"  : PaxosEvent.NACK,
+            "max_num": self.state.promised
+            }
 
     def promise(self, propose_num, log_slot):
-        logging.info(f"received prepare({propose_num}) for slot {log_slot}")
-        if propose_num > self.decorated_site.max_prepare[log_slot]:
-            self.decorated_site.max_prepare[int(log_slot)] = propose_num
+        if log_slot < self.state.floor:
+            return self.learned_nack(log_slot)
+        if propose_num > self.state.promised_num(log_slot):
+            self.state.promise(log_slot, propose_num)
+            self.decorated_site.write_promise(log_slot)
+            accepted_num, accepted_val = self.state.accepted_at(log_slot)
             ret_obj =  {
                 "origin"      : self.decorated_site.site_id,
                 "event"       : PaxosEvent.PROMISE,
-                "accepted_num": self.decorated_site.accepted_num[log_slot],
-                "accepted_val": self.decorated_site.accepted_val[log_slot]
+                "accepted_num": accepted_num,
+                "accepted_val": accepted_val
                 }
-            logging.info(f"send promise({ret_obj['accepted_num']}, {ret_obj['accepted_val']}) to slot {log_slot}")
+            self.tracer.debug("promise", log_slot, propose_num, accepted_num=accepted_num, accepted_val=accepted_val)
         else:
             ret_obj = {
                 "origin"     : self.decorated_site.site_id,
                 "event"      : PaxosEvent.NACK,
-                "max_num"    : self.decorated_site.max_prepare[log_slot]
+                "max_num"    : self.state.promised_num(log_slot)
+                }
+            self.tracer.debug("nack_prepare", log_slot, propose_num, max_num=ret_obj["max_num"])
+        return ret_obj
+
+    def promise_all(self, propose_num, from_slot, origin, chunk_bytes=16384):
+        # Multi-Paxos prepare: one promise for every slot from from_slot onward.
+        # Only accepted values from from_slot on go back, the new leader has learned every slot below it.
+        # As many as fit in one datagram, "more" tells the leader to ask again from after the last one.
+        site = self.decorated_site
+        requested_from = from_slot
+        if self.state.promised:
+            # Never shrink the range an earlier leader was promised
+            from_slot = min(from_slot, self.state.promised_from)
+        highest = self.state.highest_from(from_slot)
+        # The leader we promised asking for the next chunk
+        repeated = propose_num == highest == self.state.promised and origin == self.state.leader_id
+        if self.lease_active() and origin != self.lease_holder:
+            # The current leader may be serving reads from its lease, it can't be replaced until that runs out
+            self.tracer.debug("nack_prepare_all", from_slot, propose_num, origin=origin, max_num=highest, lease_holder=self.lease_holder)
+            return {
+                "origin"      : site.site_id,
+                "event"       : PaxosEvent.NACK,
+                "max_num"     : highest,
+                "lease_holder": self.lease_holder # Whom the proposer can forward to instead
+                }
+        if propose_num > highest or repeated:
+            if not repeated:
+                self.state.promise_from(propose_num, from_slot, origin)
+                site.write_leader_promise()
+            self.grant_lease(origin)
+            accepted = []
+            size = 0
+            pending = self.state.accepted_from(requested_from)
+            for entry in pending:
+                if size >= chunk_bytes:
+                    break
+                accepted.append(entry)
+                size += len(json.dumps(entry[2]))
+            ret_obj = {
+                "origin"   : site.site_id,
+                "event"    : PaxosEvent.PROMISE,
+                "from_slot": requested_from,
+                "accepted" : accepted,
+                "more"     : len(accepted) < len(pending)
+                }
+            self.tracer.info("promise_all", from_slot, propose_num, origin=origin, accepted=len(ret_obj["accepted"]))
+        else:
+            ret_obj = {
+                "origin"     : site.site_id,
+                "event"      : PaxosEvent.NACK,
+                "max_num"    : highest
                 }
-            logging.info(f"send nack({ret_obj['max_num']}) at slot {log_slot}")
+            self.tracer.debug("nack_prepare_all", from_slot, propose_num, origin=origin, max_num=highest)
         return ret_obj
 
     def accept(self, prop_num, prop_val, log_slot):
-        logging.info(f"received prepare({prop_num}) for slot {log_slot}")
-        if prop_num >= self.decorated_site.max_prepare[log_slot]:
-            self.decorated_site.max_prepare[log_slot] = prop_num
-            self.decorated_site.accepted_val[int(log_slot)] = prop_val
-            self.decorated_site.accepted_num[int(log_slot)] = prop_num
+        if log_slot < self.state.floor:
+            return self.learned_nack(log_slot)
+        if prop_num >= self.state.promised_num(log_slot):
+            self.state.accept(log_slot, prop_num, prop_val)
+            self.decorated_site.write_accept(log_slot)
             ret_obj =  {
                 "origin"      : self.decorated_site.site_id,
                 "event"       : PaxosEvent.ACCEPTED,
-                "accepted_num": self.decorated_site.accepted_num[log_slot],
-                "accepted_val": self.decorated_site.accepted_val[log_slot],
+                "accepted_num": prop_num,
+                "accepted_val": prop_val,
                 "log_slot"    : log_slot
                 }
-            logging.info(f"send accept({ret_obj['accepted_num']}, {ret_obj['accepted_val']}) to slot {log_slot}")
+            self.tracer.debug("accepted", log_slot, prop_num, val=prop_val)
         else:
             ret_obj = {
                 "origin"     : self.decorated_site.site_id,
                 "event"      : PaxosEvent.NACK,
-                "max_num"    : self.decorated_site.max_prepare
+                "max_num"    : self.state.promised_num(log_slot)
                 }
-            logging.info(f"Acceptor: Can't accept proposal# {prop_num} at slot {log_slot}")
+            self.tracer.debug("nack_accept", log_slot, prop_num, max_num=ret_obj["max_num"])
         return ret_obj
 
+    def learned_nack(self, log_slot):
+        # Every site has learned log_slot and we dropped what we accepted there, so we can't take part in a new round for it.
+        # Only a proposer that lost its log asks, and it has to catch up from its peers instead.
+        self.tracer.info("nack_learned", log_slot, floor=self.state.floor)
+        return {
+            "origin"     : self.decorated_site.site_id,
+            "event"      : PaxosEvent.NACK,
+            "max_num"    : self.state.promised_num(log_slot)
+            }
+
     def listen(self):
-        server_thread = threading.Thread(target=self.message_reciever)
-        server_thread.daemon = True
-        server_thread.start()
-        logging.info(f"Acceptor: Now listening on port {self.port}.")
+        self.runtime.serve("Acceptor", self.port, self.handle)
 
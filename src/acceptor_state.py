@@ -0,0 +1,82 @@
+class AcceptorState():
+    # What this acceptor has promised and accepted. Slots every site has learned are dropped,
+    # so the size follows the slots still in flight rather than the length of the log.
+    def __init__(self):
+        # Multi-Paxos promise covering every slot from promised_from onward
+        self.promised = 0
+        self.promised_from = 0
+        self.leader_id = None
+        self.slot_promised = {} # key: slot. value: ballot, only where it beats the promise above
+        self.accepted = {}      # key: slot. value: [ballot, value]
+        self.floor = 0          # Every site has learned the slots below this one, nothing is kept for them
+
+    def promised_num(self, slot):
+        # Largest ballot promised for slot
+        num = self.slot_promised.get(slot, 0)
+        if self.promised and slot >= self.promised_from:
+            num = max(num, self.promised)
+        return num
+
+    def highest_from(self, from_slot):
+        # Largest ballot promised for any slot from from_slot onward
+        return max([self.promised] + [n for s, n in self.slot_promised.items() if s >= from_slot])
+
+    def promise(self, slot, num):
+        if slot >= self.floor and num > self.promised_num(slot):
+            self.slot_promised[slot] = num
+
+    def promise_from(self, num, from_slot, leader_id):
+        self.promised = num
+        self.promised_from = from_slot
+        self.leader_id = leader_id
+        # Slot promises the new one covers are no longer needed
+        self.slot_promised = {s: n for s, n in self.slot_promised.items() if s < from_slot or n > num}
+
+    def accept(self, slot, num, val):
+        if slot < self.floor:
+            return
+        self.promise(slot, num)
+        self.accepted[slot] = [num, val]
+
+    def accepted_at(self, slot):
+        # [ballot, value], or [None, None] if nothing was accepted for slot
+        return self.accepted.get(slot, [None, None])
+
+    def accepted_from(self, from_slot):
+        return [[s, n, v] for s, (n, v) in sorted(self.accepted.items()) if s >= from_slot]
+
+    def collect(self, watermark):
+        # Every site has learned the slots below watermark, so no proposer will ask about them again. Returns how many entries went.
+        if watermark <= self.floor:
+            return 0
+        self.floor = watermark
+        stale = [s for s in self.slot_promised if s < watermark]
+        for s in stale:
+            del self.slot_promised[s]
+        stale_accepted = [s for s in self.accepted if s < watermark]
+        for s in stale_accepted:
+            del self.accepted[s]
+        return len(stale) + len(stale_accepted)
+
+    def __len__(self):
+        return len(self.slot_promised) + len(self.accepted)
+
+    def dump(self):
+        # Lists rather than dicts, JSON would turn the slots into strings
+        return {
+            "promised"      : self.promised,
+            "promised_from" : self.promised_from,
+            "leader_id"     : self.leader_id,
+            "slot_promised" : sorted(self.slot_promised.items()),
+            "accepted"      : self.accepted_from(self.floor),
+            "floor"         : self.floor
+            }
+
+    def load(self, snapshot):
+        self.__init__()
+        self.promised = snapshot["promised"]
+        self.promised_from = snapshot["promised_from"]
+        self.leader_id = snapshot["leader_id"]
+        self.slot_promised = {s: n for s, n in snapshot["slot_promised"]}
+        self.accepted = {s: [n, v] for s, n, v in snapshot["accepted"]}
+        self.floor = snapshot["floor"]
@@ -0,0 +1,260 @@
+import argparse
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+from metrics import Histogram
+
+# Launches a cluster on loopback, drives it through stdin like a user would and reads the results back from each site's stats.
+# Example: python3 src/bench.py --sites 5 --clients 5 --ops 200 --config '{"leader_mode": true}'
+
+SITE_NAMES = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", "iota", "kappa"]
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+STATS_RE = re.compile(r"Stats: (\{.*\})$")
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Local multi-site Paxos benchmark")
+    parser.add_argument("--sites", type=int, default=3, help="sites in the cluster")
+    parser.add_argument("--clients", type=int, default=None, help="sites that issue commands, defaults to all. More clients, more contention for slots")
+    parser.add_argument("--ops", type=int, default=100, help="commands each client issues")
+    parser.add_argument("--projects", type=int, default=4, help="shared projects pledges go to. Fewer projects, more contention per project")
+    parser.add_argument("--mix", default="pledge=6,withdraw=2,create=1,cancel=1", help="relative weight of each command")
+    parser.add_argument("--config", default="{}", help="JSON merged into the cluster config")
+    parser.add_argument("--dir", default="/tmp/paxos-bench", help="working directory, wiped first")
+    parser.add_argument("--port", type=int, default=6000, help="first udp_start_port, each site gets 10 ports or 4 per Paxos group")
+    parser.add_argument("--startup", type=float, default=2, help="seconds to let the sites find each other")
+    parser.add_argument("--timeout", type=float, default=600, help="give up on the run after this many seconds")
+    parser.add_argument("--script", action="store_true", help="run the sites with --script -, so each client's commands are in flight at once")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+def ports_per_site(args):
+    return max(10, 4 * json.loads(args.config).get("groups", 1))
+
+def write_knownhosts(args, names):
+    hosts = {}
+    stride = ports_per_site(args)
+    for i, name in enumerate(names):
+        port = args.port + stride * i
+        hosts[name] = {"ip_address": "127.0.0.1", "udp_start_port": port, "udp_end_port": port + stride - 1}
+    with open(os.path.join(args.dir, "knownhosts.json"), "w") as f:
+        json.dump({"hosts": hosts, "config": json.loads(args.config)}, f, indent=4)
+
+class SiteProcess():
+    def __init__(self, name, directory, script=False):
+        self.name = name
+        self.err_path = os.path.join(directory, f"{name}.err")
+        self.lines = []
+        self.cond = threading.Condition()
+        self.proc = subprocess.Popen([sys.executable, MAIN, name] + (["--script", "-"] if script else []), cwd=directory, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=open(self.err_path, "w"), text=True, bufsize=1)
+        reader = threading.Thread(target=self.read_stdout)
+        reader.daemon = True
+        reader.start()
+        self.rusage = None
+
+    def read_stdout(self):
+        for line in self.proc.stdout:
+            with self.cond:
+                self.lines.append(line.rstrip("\n"))
+                self.cond.notify_all()
+
+    def send(self, commands):
+        # Written from a thread so a full pipe never blocks the harness
+        def writer():
+            for command in commands:
+                self.proc.stdin.write(command + "\n")
+            self.proc.stdin.flush()
+        t = threading.Thread(target=writer)
+        t.daemon = True
+        t.start()
+
+    def wait_for(self, pattern, count, timeout):
+        deadline = time.time() + timeout
+        with self.cond:
+            while sum(1 for line in self.lines if pattern in line) < count:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise Exception(f"{self.name} did not print {count} x '{pattern}' in time")
+                self.cond.wait(remaining)
+
+    def wait(self, timeout):
+        # wait4 hands back the child's CPU time along with its exit status
+        deadline = time.time() + timeout
+        while True:
+            pid, status, rusage = os.wait4(self.proc.pid, os.WNOHANG)
+            if pid:
+                self.rusage = rusage
+                self.proc.returncode = status
+                return
+            if time.time() > deadline:
+                self.proc.kill()
+                raise Exception(f"{self.name} did not exit in time")
+            time.sleep(0.05)
+
+def scrape(port, timeout=2):
+    # Same request monitoring makes against the stats port
+    stats_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stats_socket.settimeout(timeout)
+    try:
+        stats_socket.sendto(b"stats", ("127.0.0.1", port))
+        message, _ = stats_socket.recvfrom(65536)
+        return json.loads(message.decode("utf-8"))
+    finally:
+        stats_socket.close()
+
+def make_workload(args, site_index, name, rng, mix):
+    commands = []
+    user = f"{name}-"
+    pledge_counter = 1 # Mirrors the site's own counter, assuming every pledge goes through
+    own_pledges = []
+    own_projects = []
+    actions = list(mix.keys())
+    weights = list(mix.values())
+    for _ in range(args.ops):
+        action = rng.choices(actions, weights)[0]
+        if action == "withdraw" and own_pledges:
+            if args.script:
+                # The pledge has to be in before it can be withdrawn
+                commands.append("wait")
+            commands.append(f"withdraw {own_pledges.pop(rng.randrange(len(own_pledges)))}")
+        elif action == "cancel" and own_projects:
+            if args.script:
+                commands.append("wait")
+            commands.append(f"cancel {own_projects.pop(rng.randrange(len(own_projects)))}")
+        elif action == "create" or action == "cancel":
+            project = f"{name}-p{len(commands)}"
+            own_projects.append(project)
+            commands.append(f"create {project} {100 * 10**6}")
+        else:
+            project = f"shared{rng.randrange(args.projects)}"
+            commands.append(f"pledge {user} {project}")
+            own_pledges.append(f"{user}{pledge_counter}")
+            pledge_counter += 1
+    return commands
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def collect(site):
+    # Stats the site logged as it quit
+    stats = None
+    with open(site.err_path) as f:
+        for line in f:
+            m = STATS_RE.search(line)
+            if m:
+                stats = json.loads(m.group(1))
+    return stats
+
+def phase_histogram(stats, before, name):
+    # The site's histogram of name, less what it already held before the measured phase
+    histogram = Histogram()
+    after = stats["histograms"].get(name)
+    if not after:
+        return histogram
+    earlier = before["histograms"].get(name, {"count": 0, "buckets": {}})
+    for i, n in after["buckets"].items():
+        histogram.buckets[int(i)] = n - earlier["buckets"].get(i, 0)
+    histogram.count = after["count"] - earlier["count"]
+    histogram.max = after["max"]
+    return histogram
+
+def main():
+    args = parse_args()
+    if args.sites > len(SITE_NAMES):
+        sys.exit(f"At most {len(SITE_NAMES)} sites")
+    clients = args.clients or args.sites
+    mix = {k: float(v) for k, v in (item.split("=") for item in args.mix.split(","))}
+    rng = random.Random(args.seed)
+
+    shutil.rmtree(args.dir, ignore_errors=True)
+    os.makedirs(args.dir)
+    names = SITE_NAMES[:args.sites]
+    write_knownhosts(args, names)
+
+    sites = [SiteProcess(name, args.dir, args.script) for name in names]
+    try:
+        time.sleep(args.startup)
+
+        # Shared projects are created up front with a goal nobody will reach
+        sites[0].send([f"create shared{i} {100 * 10**6}" for i in range(args.projects)])
+        sites[0].wait_for("Created project", args.projects, args.timeout)
+
+        workloads = [make_workload(args, i, names[i], rng, mix) for i in range(clients)]
+        # Startup and setup traffic doesn't count towards messages per commit
+        baseline = [scrape(args.port + ports_per_site(args) * i + 3) for i in range(args.sites)]
+        phase_start = time.time()
+        for site, commands in zip(sites, workloads):
+            site.send(commands + ["echo bench-done"])
+        # Every site stays up until the last client is done, a leader quitting early would turn the tail into failovers
+        for site in sites[:clients]:
+            site.wait_for("bench-done", 1, args.timeout)
+        phase_end = time.time()
+        for site in sites:
+            site.send(["quit"])
+        for site in sites:
+            site.wait(args.timeout)
+    finally:
+        for site in sites:
+            if site.proc.poll() == None and site.rusage == None:
+                site.proc.kill()
+
+    latencies = Histogram()
+    commits = 0
+    sent = 0
+    retries = 0
+    failed = 0
+    cpu = {}
+    for site, before in zip(sites, baseline):
+        stats = collect(site)
+        if stats:
+            latencies.merge(phase_histogram(stats, before, "action"))
+            commits += stats["counters"].get("actions.committed", 0) - before["counters"].get("actions.committed", 0)
+            sent += stats["counters"].get("sent", 0) - before["counters"].get("sent", 0)
+            retries += stats["counters"].get("retries", 0) - before["counters"].get("retries", 0)
+            failed += stats["counters"].get("failed_proposals", 0) - before["counters"].get("failed_proposals", 0)
+        cpu[site.name] = round(site.rusage.ru_utime + site.rusage.ru_stime, 3)
+
+    elapsed = phase_end - phase_start
+    report = {
+        "sites"             : args.sites,
+        "clients"           : clients,
+        "commands"          : sum(len([c for c in w if c != "wait"]) for w in workloads),
+        "proposals"         : latencies.count,
+        "commits"           : commits,
+        "seconds"           : round(elapsed, 3),
+        "commits_per_sec"   : round(commits / elapsed, 2) if elapsed else 0,
+        "p50_ms"            : round(latencies.percentile(50), 2),
+        "p99_ms"            : round(latencies.percentile(99), 2),
+        "messages_per_commit": round(sent / commits, 2) if commits else 0,
+        "retries"           : retries,
+        "failed_proposals"  : failed,
+        "cpu_seconds"       : cpu,
+        "config"            : json.loads(args.config)
+        }
+    if args.json:
+        print(json.dumps(report))
+        return
+    print(f"{report['sites']} sites, {report['clients']} clients, {report['commands']} commands, {report['proposals']} proposals in {report['seconds']} s")
+    print(f"commits/sec       {report['commits_per_sec']}")
+    print(f"latency p50       {report['p50_ms']} ms")
+    print(f"latency p99       {report['p99_ms']} ms")
+    print(f"messages/commit   {report['messages_per_commit']}")
+    print(f"retries           {report['retries']}")
+    print(f"failed proposals  {report['failed_proposals']}")
+    for name, seconds in cpu.items():
+        print(f"cpu {name:<13} {seconds} s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import concurrent.futures
+import threading
+from proposer import Outcome
+
+class QueueFull(Exception):
+    pass
+
+def parse(text):
+    # (method of the front, args) for a user command, None if it isn't one
+    split_text = text.strip(" \n").split(" ")
+    command = split_text[0]
+    if command == "log" and len(split_text) == 1:
+        return "log", ()
+    elif command == "log" and len(split_text) == 3 and split_text[1].isdigit() and split_text[2].isdigit():
+        # Slots in [from, to)
+        return "log", (int(split_text[1]), int(split_text[2]))
+    elif command == "projects" and len(split_text) == 1:
+        return "projects", ()
+    elif command == "projects" and len(split_text) in (2, 3) and split_text[1].isdigit():
+        # A page of count projects, starting after the name given
+        return "projects", (int(split_text[1]),) + tuple(split_text[2:])
+    elif command == "list" and len(split_text) == 2:
+        return "list_out", (split_text[1],)
+    elif command == "list" and len(split_text) == 4 and split_text[2].isdigit() and split_text[3].isdigit():
+        # A page of count pledges, skipping the first offset
+        return "list_out", (split_text[1], int(split_text[2]), int(split_text[3]))
+    elif command == "create" and len(split_text) == 3 and split_text[2].isdigit():
+        return "create_project", (split_text[1], int(split_text[2]))
+    elif command == "pledge" and len(split_text) == 3:
+        return "create_pledge", (split_text[2], split_text[1])
+    elif command == "withdraw" and len(split_text) == 2:
+        return "withdraw_pledge", (split_text[1],)
+    elif command == "cancel" and len(split_text) == 2:
+        return "cancel_project", (split_text[1],)
+    return None
+
+class Client():
+    # Non-blocking entry point for user commands. submit() returns a Future of the command's Outcome,
+    # which carries the slot it was committed in. Commands run concurrently, so one slow proposal holds up nobody else.
+    # At most max_pending commands are queued or running. Past that submit waits for room, or raises QueueFull if told not to.
+    # The front hands back a Future for each command, nothing here waits on it.
+
+    def __init__(self, front, max_pending):
+        self.front = front
+        self.max_pending = max_pending
+        self.room = threading.BoundedSemaphore(max_pending)
+        self.outstanding = set()
+        self.lock = threading.Lock()
+
+    def submit(self, text, block=True):
+        command = parse(text)
+        if command == None:
+            future = concurrent.futures.Future()
+            future.set_result(Outcome(False, ["Check your input!"]))
+            return future
+        if not self.room.acquire(blocking=block):
+            raise QueueFull(f"{self.max_pending} commands already pending, {text} rejected")
+        name, args = command
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.outstanding.add(future)
+        try:
+            running = self.front.submit(name, *args)
+        except Exception as e:
+            running = concurrent.futures.Future()
+            running.set_exception(e)
+        running.add_done_callback(lambda running: self.done(future, name, running))
+        return future
+
+    def done(self, future, name, running):
+        # Runs on whichever thread finished the command, so it must not block
+        self.room.release()
+        try:
+            outcome = running.result()
+        except Exception as e:
+            outcome = Outcome(False, [f"{name} failed, {e}"])
+        # A worker process that failed the call answers None
+        future.set_result(outcome if outcome != None else Outcome(False, [f"{name} failed."]))
+        with self.lock:
+            self.outstanding.discard(future)
+
+    def drain(self):
+        # Blocks until every command submitted so far is done
+        with self.lock:
+            outstanding = list(self.outstanding)
+        concurrent.futures.wait(outstanding)
+
+    def close(self):
+        self.drain()
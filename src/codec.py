@@ -0,0 +1,196 @@
+import json
+import struct
+
+# Ballots are ints packing a round and the proposing site, round in the high bits.
+# Comparing two ballots compares rounds first, so no two sites ever share one.
+BALLOT_SITE_BITS = 16
+
+def ballot(round_num, site_id):
+    return (round_num << BALLOT_SITE_BITS) | site_id
+
+def ballot_round(num):
+    return num >> BALLOT_SITE_BITS
+
+def ballot_site(num):
+    return num & ((1 << BALLOT_SITE_BITS) - 1)
+
+def next_ballot(num, site_id):
+    # Smallest ballot of ours that beats num
+    return ballot(ballot_round(num) + 1, site_id)
+
+# Binary frames start with 0x80 | version so they can't be confused with JSON, which starts with '{'
+VERSION = 1
+# version, event, flags, log_slot, ballot round, ballot site
+HEADER = struct.Struct("<BBBqIH")
+HAS_SLOT   = 1
+HAS_BALLOT = 2
+
+# Known keys go on the wire as one byte. Append only, the index is the wire tag.
+FIELDS = [
+    None, # 0: key follows as a string
+    "origin", "accepted_num", "accepted_val", "max_num", "from_slot", "accepted",
+    "watermark", "cur_slot", "log_base", "offset", "total", "data", "committed",
+    "commit_val", "propose_val", "all_slots",
+    # UserAction payloads
+    "action", "actions", "project_name", "funding_goal", "pledge_id", "site_name", "proposal_id",
+    "index", "to_slot", "next_slot", "entries", "cluster_watermark", "commit_index",
+    "request_id", "more", "lease_holder", "lease", "version",
+]
+FIELD_TAGS = {key: tag for tag, key in enumerate(FIELDS) if key}
+
+# Value type markers
+NONE, TRUE, FALSE, INT, NEG_INT, FLOAT, STR, LIST, DICT = range(9)
+DOUBLE = struct.Struct("<d")
+
+def write_varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def read_varint(data, offset):
+    n = 0
+    shift = 0
+    while True:
+        b = data[offset]
+        offset += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, offset
+        shift += 7
+
+def write_str(out, s):
+    raw = s.encode("utf-8")
+    write_varint(out, len(raw))
+    out += raw
+
+def read_str(data, offset):
+    length, offset = read_varint(data, offset)
+    return data[offset:offset + length].decode("utf-8"), offset + length
+
+def write_key(out, key):
+    tag = FIELD_TAGS.get(key)
+    if tag:
+        out.append(tag)
+    else:
+        out.append(0)
+        write_str(out, key)
+
+def read_key(data, offset):
+    tag = data[offset]
+    offset += 1
+    if tag:
+        return FIELDS[tag], offset
+    return read_str(data, offset)
+
+def write_value(out, value):
+    if value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        out.append(INT if value >= 0 else NEG_INT)
+        write_varint(out, abs(value))
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += DOUBLE.pack(value)
+    elif isinstance(value, str):
+        out.append(STR)
+        write_str(out, value)
+    elif isinstance(value, (list, tuple)):
+        out.append(LIST)
+        write_varint(out, len(value))
+        for item in value:
+            write_value(out, item)
+    elif isinstance(value, dict):
+        out.append(DICT)
+        write_varint(out, len(value))
+        for key, item in value.items():
+            write_key(out, str(key))
+            write_value(out, item)
+    else:
+        raise TypeError(f"Can't encode {type(value)}")
+
+def read_value(data, offset):
+    kind = data[offset]
+    offset += 1
+    if kind == NONE:
+        return None, offset
+    if kind == TRUE:
+        return True, offset
+    if kind == FALSE:
+        return False, offset
+    if kind == INT or kind == NEG_INT:
+        n, offset = read_varint(data, offset)
+        return (n if kind == INT else -n), offset
+    if kind == FLOAT:
+        return DOUBLE.unpack_from(data, offset)[0], offset + DOUBLE.size
+    if kind == STR:
+        return read_str(data, offset)
+    if kind == LIST:
+        count, offset = read_varint(data, offset)
+        items = []
+        for _ in range(count):
+            item, offset = read_value(data, offset)
+            items.append(item)
+        return items, offset
+    if kind == DICT:
+        count, offset = read_varint(data, offset)
+        items = {}
+        for _ in range(count):
+            key, offset = read_key(data, offset)
+            items[key], offset = read_value(data, offset)
+        return items, offset
+    raise ValueError(f"Unknown value type {kind}")
+
+def encode_binary(obj):
+    # event, log_slot and propose_num ride in the fixed header, everything else is tagged fields
+    flags = 0
+    slot = obj.get("log_slot")
+    num = obj.get("propose_num")
+    if slot is not None:
+        flags |= HAS_SLOT
+    if num is not None:
+        flags |= HAS_BALLOT
+    out = bytearray(HEADER.pack(0x80 | VERSION, obj.get("event", 0), flags, slot or 0,
+                                ballot_round(num or 0), ballot_site(num or 0)))
+    for key, value in obj.items():
+        if key in ("event", "log_slot", "propose_num"):
+            continue
+        write_key(out, key)
+        write_value(out, value)
+    return bytes(out)
+
+def decode_binary(data):
+    version, event, flags, slot, round_num, site = HEADER.unpack_from(data)
+    if version != 0x80 | VERSION:
+        raise ValueError(f"Unsupported wire version {version & 0x7f}")
+    obj = {"event": event}
+    if flags & HAS_SLOT:
+        obj["log_slot"] = slot
+    if flags & HAS_BALLOT:
+        obj["propose_num"] = ballot(round_num, site)
+    offset = HEADER.size
+    while offset < len(data):
+        key, offset = read_key(data, offset)
+        obj[key], offset = read_value(data, offset)
+    return obj
+
+def encode_json(obj):
+    return json.dumps(obj).encode("utf-8")
+
+def decode_json(data):
+    return json.loads(data.decode("utf-8"))
+
+ENCODERS = {
+    "binary": encode_binary,
+    "json"  : encode_json,
+}
+
+def decode(data):
+    # Either format is accepted, so a site switched to JSON for debugging still talks to the rest
+    if data[0] & 0x80:
+        return decode_binary(data)
+    return decode_json(data)
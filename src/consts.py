@@ -5,6 +5,8 @@ class UserAction(int, Enum):
     CANCEL_PROJECT  = 2
     CREATE_PLEDGE   = 3
     WITHDRAW_PLEDGE = 4
+    BATCH           = 5 # Several of the above committed in one slot, value carries them in "actions"
+    NOOP            = 6 # Fills a hole nobody proposed into, so later slots can be applied
 
 class PaxosEvent(int, Enum):
     PREPARE = 1 
@@ -15,6 +17,31 @@ class PaxosEvent(int, Enum):
     NACK    = 6
     COMMIT  = 7
     SEEK    = 8 # For hole filling. Not sending any value, just seeking missed values.
+    FORWARD = 9 # Non-leader handing a proposal over to the leader's proposer.
+    SNAPSHOT= 10 # Lagging site fetching a peer's snapshot, one chunk at a time.
+    LEASE   = 11 # Leader renewing its read lease with the acceptors.
+    READ_INDEX = 12 # Asking the leader which slot local state must reach before a read.
+    FETCH   = 13 # Lagging learner copying a range of learned entries from a peer.
+
+# Cluster wide options. Can be overridden by a "config" section in knownhosts.json
+DEFAULT_CONFIG = {
+    "leader_mode"        : False, # Multi-Paxos: a stable leader skips phase 1 for consecutive slots
+    "wal_segment_bytes"  : 4 * 1024 * 1024,
+    "wal_group_commit_ms": 2, # How long the flusher waits for more records before each fsync
+    "snapshot_interval"  : 1000, # Learned entries between snapshots
+    "batch_size"         : 1, # Most user actions per slot. 1 turns batching off
+    "batch_linger_ms"    : 5, # How long a batch waits for more actions before it is proposed
+    "pipeline_window"    : 1, # Slots a site may have in flight at once
+    "thrifty"            : False, # Send prepares and accepts to the fastest majority only, everyone else only if they are late
+    "wire_codec"         : "binary", # "binary", or "json" for readable packets while debugging
+    "lease_ms"           : 2000, # Leader read lease in leader_mode. 0 turns leases off
+    "groups"             : 1, # Independent Paxos groups per site, projects are spread over them by name. Each takes 4 ports.
+    "processes"          : 1, # Worker processes the groups are spread over, at most groups. 1 runs everything in the main process.
+    "client_queue"       : 256, # User commands a site takes on at once before new ones wait, or are turned away by Client.submit(block=False)
+    "trace_level"        : "info", # "off", "info" for role changes and failures, or "debug" for every protocol message
+    "trace_ring"         : 4096, # Most recent trace events kept in memory for the trace command
+    "trace_file"         : False, # Also append trace events to logs/trace<site_id>.bin, see trace_merge.py
+    }
 
 class Event(dict):
     def __hash__(self):
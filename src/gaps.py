@@ -0,0 +1,86 @@
+from bisect import bisect_right
+
+class GapIndex():
+    # Slots missing from the log, kept as sorted, disjoint [start, end) ranges.
+    # Every slot from self.end onward is missing as well, that's where new proposals go.
+    def __init__(self, base=0):
+        self.starts = []
+        self.ends = []
+        self.end = base # One past the highest slot known to exist
+
+    def watermark(self):
+        # Every slot below this one has been learned
+        return self.starts[0] if self.starts else self.end
+
+    def find(self, slot):
+        # Index of the range holding slot, or -1
+        i = bisect_right(self.starts, slot) - 1
+        if i >= 0 and slot < self.ends[i]:
+            return i
+        return -1
+
+    def is_missing(self, slot):
+        return slot >= self.end or self.find(slot) >= 0
+
+    def extend_to(self, slot):
+        # Slots below slot exist somewhere. The ones we don't have yet become gaps.
+        if slot <= self.end:
+            return
+        if self.ends and self.ends[-1] == self.end:
+            self.ends[-1] = slot
+        else:
+            self.starts.append(self.end)
+            self.ends.append(slot)
+        self.end = slot
+
+    def fill(self, slot):
+        # slot has been learned
+        if slot >= self.end:
+            self.extend_to(slot)
+            self.end = slot + 1
+            return
+        i = self.find(slot)
+        if i < 0:
+            return
+        start, end = self.starts[i], self.ends[i]
+        if start == slot and end == slot + 1:
+            del self.starts[i]
+            del self.ends[i]
+        elif start == slot:
+            self.starts[i] = slot + 1
+        elif end == slot + 1:
+            self.ends[i] = slot
+        else:
+            self.ends[i] = slot
+            self.starts.insert(i + 1, slot + 1)
+            self.ends.insert(i + 1, end)
+
+    def open(self, slot):
+        # slot is missing again, only used by the rm debug command
+        if self.is_missing(slot):
+            return
+        i = bisect_right(self.starts, slot)
+        joins_left = i > 0 and self.ends[i - 1] == slot
+        joins_right = i < len(self.starts) and self.starts[i] == slot + 1
+        if joins_left and joins_right:
+            self.ends[i - 1] = self.ends[i]
+            del self.starts[i]
+            del self.ends[i]
+        elif joins_left:
+            self.ends[i - 1] = slot + 1
+        elif joins_right:
+            self.starts[i] = slot
+        else:
+            self.starts.insert(i, slot)
+            self.ends.insert(i, slot + 1)
+
+    def ranges(self):
+        # Missing ranges below self.end, in slot order
+        return list(zip(self.starts, self.ends))
+
+    def __iter__(self):
+        for start, end in self.ranges():
+            yield from range(start, end)
+
+    def __len__(self):
+        return sum(end - start for start, end in zip(self.starts, self.ends))
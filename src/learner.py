@@ -1,84 +1,140 @@
-import logging, sys
+import asyncio
 import json
-import threading
-import socket
-import traceback
-from consts import PaxosEvent, UserAction
+from consts import PaxosEvent
 from paxos_site import AbstractSiteDecorator
 
+# How long a hole below a known commit index gets to fill from COMMITs still on their way before it is pulled
+PULL_DELAY = 0.02
+
+async def fetch_range(runtime, site, addr, from_slot, to_slot):
+    # Copies learned entries in [from_slot, to_slot) from the learner at addr. Returns how many were new to us.
+    learned = 0
+    slot = from_slot
+    while slot < to_slot:
+        obj = {
+                "event"    : PaxosEvent.FETCH,
+                "from_slot": slot,
+                "to_slot"  : to_slot
+                }
+        res = await runtime.request(obj, [addr], 1, 0.5)
+        if not res or res[0]["next_slot"] <= slot:
+            # Peer is down or doesn't have these slots any more
+            break
+        for entry_slot, val in res[0]["entries"]:
+            if site.learn(val, entry_slot):
+                learned += 1
+        slot = res[0]["next_slot"]
+    return learned
+
 class Learner(AbstractSiteDecorator):
-    def __init__(self, decorated_site):
+    def __init__(self, decorated_site, runtime):
         super().__init__(decorated_site)
-        self.port = self.decorated_site.site_dict[self.decorated_site.site_id]["udp_start_port"] + 2
-        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+        self.runtime = runtime
+        self.port = self.decorated_site.port(self.decorated_site.site_id, 2)
+        self.tracer = self.decorated_site.tracer
+        self.pulling = False
 
-    def message_reciever(self):
-        server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        server_socket.bind(("", self.port))
-
-        while True:
-            try:
-                message, address = server_socket.recvfrom(32768)
-                decoded_message = json.loads(message.decode("utf-8"))
-                event = decoded_message["event"]
-                if event == PaxosEvent.COMMIT:
-                    res = self.learn(decoded_message["commit_val"], decoded_message["log_slot"])
-                elif event == PaxosEvent.SEEK:
-                    res = self.seek()
-                else:
-                    raise Exception("Unknown event for learner!")
-                server_socket.sendto(json.dumps(res).encode("utf-8"), address)
-            except Exception as e:
-                logging.info(f"Learner: Error while receiving: {e}")
-                logging.info(traceback.format_exc())
+    def handle(self, decoded_message):
+        event = decoded_message["event"]
+        if event == PaxosEvent.COMMIT:
+            if "origin" in decoded_message:
+                self.decorated_site.peer_watermarks[decoded_message["origin"]] = decoded_message["watermark"]
+                self.decorated_site.reported_cluster_watermark = max(self.decorated_site.reported_cluster_watermark,
+                                                                     decoded_message.get("cluster_watermark", 0))
+            self.learn(decoded_message["commit_val"], decoded_message["log_slot"])
+            if "origin" not in decoded_message:
+                return None
+            # Everything below the sender's watermark is chosen too
+            self.note_commit_index(decoded_message["watermark"], decoded_message["origin"])
+            return {
+                "origin"   : self.decorated_site.site_id,
+                "event"    : PaxosEvent.ACK,
+                "watermark": self.decorated_site.cur_log_slot()
+                }
+        elif event == PaxosEvent.SEEK:
+            return self.seek()
+        elif event == PaxosEvent.SNAPSHOT:
+            return self.snapshot_chunk(decoded_message["offset"])
+        elif event == PaxosEvent.FETCH:
+            return self.fetch(decoded_message["from_slot"], decoded_message["to_slot"])
+        raise Exception("Unknown event for learner!")
 
     def listen(self):
-        server_thread = threading.Thread(target=self.message_reciever)
-        server_thread.daemon = True
-        server_thread.start()
-        logging.info(f"Learner: Now listening on port {self.port}.")
+        self.runtime.serve("Learner", self.port, self.handle)
 
     def seek(self):
-        logging.info("received seek (learner)")
+        self.tracer.debug("seek")
         return {
-                "event"   : PaxosEvent.ACK,
-                "cur_slot": self.decorated_site.cur_log_slot()
+                "origin"   : self.decorated_site.site_id,
+                "event"    : PaxosEvent.ACK,
+                "cur_slot" : self.decorated_site.cur_log_slot(),
+                "watermark": self.decorated_site.cur_log_slot(),
+                "log_base" : self.decorated_site.log_base
                 }
 
-    def learn(self, val, log_slot):
-        logging.info(f"received commit{val} for slot {log_slot}")
-        if log_slot >= len(self.decorated_site.p_log) or self.decorated_site.p_log[log_slot] == None:
-            # Add to log only if it's None
-            self.decorated_site.safe_add_log(val, log_slot)
-            if val["action"] == UserAction.CREATE_PROJECT:
-                if val["project_name"] not in self.decorated_site.cancelled_projects:
-                    self.decorated_site.crowdfund[val["project_name"]] = val["funding_goal"]
-                    self.decorated_site.pledges[val["project_name"]] = self.decorated_site.ghost_pledged[val["project_name"]]
-                    del self.decorated_site.ghost_pledged[val["project_name"]]
+    def snapshot_chunk(self, offset, chunk_size=8192):
+        # Snapshot is ascii json, so any cut is safe. Small chunks leave room for escaping.
+        blob = self.decorated_site.snapshot_blob or ""
+        return {
+                "origin" : self.decorated_site.site_id,
+                "event"  : PaxosEvent.ACK,
+                "offset" : offset,
+                "total"  : len(blob),
+                "version": self.decorated_site.snapshot_version,
+                "data"   : blob[offset:offset + chunk_size]
+                }
 
-            elif val["action"] == UserAction.CREATE_PLEDGE:
-                if val["pledge_id"] in self.decorated_site.cancelled_pledges:
-                    pass
-                elif val["project_name"] in self.decorated_site.crowdfund:
-                    # If we have officialy created the project, and it's not cancelled
-                    l = [val["pledge_id"], val["site_name"]]
-                    self.decorated_site.pledges[val["project_name"]].append(l)
-                else:
-                    # If we receive pledge without officially created project
-                    self.decorated_site.ghost_pledged[val["project_name"]].append(val)
+    def fetch(self, from_slot, to_slot, chunk_bytes=16384):
+        # Learned entries in [from_slot, to_slot), as many as fit in one datagram. next_slot is where the next chunk starts.
+        site = self.decorated_site
+        entries = []
+        size = 0
+        slot = max(from_slot, site.log_base)
+        end = min(to_slot, site.log_base + len(site.p_log))
+        if from_slot < site.log_base:
+            # Compacted away, the requester needs our snapshot instead
+            slot = end = from_slot
+        while slot < end and size < chunk_bytes:
+            val = site.get_entry(slot)
+            if val != None:
+                entries.append([slot, val])
+                size += len(json.dumps(val))
+            slot += 1
+        return {
+                "origin"   : site.site_id,
+                "event"    : PaxosEvent.ACK,
+                "entries"  : entries,
+                "next_slot": slot,
+                "log_base" : site.log_base
+                }
 
-            elif val["action"] == UserAction.CANCEL_PROJECT:
-                self.decorated_site.cancelled_projects.append(val["project_name"])
-                if val["project_name"] in self.decorated_site.crowdfund:
-                    self.decorated_site.crowdfund.pop(val.get("project_name"))
-                    self.decorated_site.pledges.pop(val.get("project_name"))      
+    def note_commit_index(self, index, origin):
+        # Every slot below index is chosen and learned at origin. Whatever we miss of them gets pulled from there.
+        site = self.decorated_site
+        if index <= site.cur_log_slot() or origin == site.site_id:
+            return
+        site.gaps.extend_to(index)
+        if not self.pulling:
+            self.pulling = True
+            asyncio.ensure_future(self.pull(index, origin))
 
-            elif val["action"] == UserAction.WITHDRAW_PLEDGE:
-                self.decorated_site.cancelled_pledges.append(val["pledge_id"])
-                if val["project_name"] in self.decorated_site.crowdfund:
-                    for v in self.decorated_site.pledges[val["project_name"]]:
-                        if v[0] == val["pledge_id"]:
-                            self.decorated_site.pledges[val["project_name"]].remove(v)
-                            break
+    async def pull(self, index, origin):
+        site = self.decorated_site
+        try:
+            await asyncio.sleep(PULL_DELAY)
+            addr = (site.site_dict[origin]["ip_address"], site.port(origin, 2))
+            for gap_start, gap_end in site.gaps.ranges():
+                if gap_start >= index:
+                    break
+                self.tracer.debug("pull", gap_start, origin=origin, to_slot=min(gap_end, index))
+                self.decorated_site.metrics.incr("learner.pulls")
+                learned = await fetch_range(self.runtime, site, addr, gap_start, min(gap_end, index))
+                self.decorated_site.metrics.incr("learner.pulled", learned)
+        except Exception as e:
+            self.tracer.info("pull_failed", origin=origin, error=str(e))
+        finally:
+            self.pulling = False
 
-            self.decorated_site.write_log()
+    def learn(self, val, log_slot):
+        self.tracer.debug("commit", log_slot, val=val)
+        self.decorated_site.learn(val, log_slot)
@@ -1,62 +1,108 @@
 import signal
+import json
 import logging
 import sys
+import threading
 import paxos_site
-from proposer import Proposer
-from acceptor import Acceptor
-from learner  import Learner
+from client   import Client, parse
+from runtime  import Runtime
+from shards   import Shards, LocalShards
+from workers  import Workers
+from metrics  import Metrics
+from tracing  import LEVELS
 
 def main():
     signal.signal(signal.SIGINT, lambda _: sys.exit(0))
     logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
 
-    mysite = paxos_site.Site()
+    site_name, site_dict, config = paxos_site.load_knownhosts()
+    stats_port = site_dict[site_name]["udp_start_port"] + 3
+    if config["processes"] > 1:
+        # Paxos groups run in worker processes, this one only reads commands and serves stats
+        shards = Workers(config)
+        runtime = Runtime(Metrics(), config["wire_codec"])
+        runtime.start()
+        runtime.serve_stats(stats_port, shards.dump_stats)
+    else:
+        mysite = paxos_site.Site()
+        runtime = Runtime(mysite.metrics, config["wire_codec"])
+        runtime.start()
+        # Acceptor, learner and proposer of every Paxos group
+        local_shards = Shards(mysite, runtime)
+        runtime.run(local_shards.start())
+        runtime.serve_stats(stats_port)
+        shards = LocalShards(local_shards, runtime)
+    client = Client(shards, config["client_queue"])
 
-    myacceptor = Acceptor(mysite)
-    myacceptor.listen()
+    # With --script the commands come from a file, or a pipe for "-", and user commands don't wait for each other.
+    # Each one's lines are printed as it finishes. "wait" holds the script until everything before it is done.
+    source = None
+    if "--script" in sys.argv:
+        script = sys.argv[sys.argv.index("--script") + 1]
+        source = sys.stdin if script == "-" else open(script)
+    print_lock = threading.Lock()
 
-    mylearner = Learner(mysite)
-    mylearner.listen()
+    def show(outcome):
+        with print_lock:
+            for line in outcome.lines:
+                print(line)
+            sys.stdout.flush()
 
-    myproposer = Proposer(mysite)
-    
     while True:
         
-        text = input().strip(" \n")
+        try:
+            text = input() if source == None else next(source)
+        except (EOFError, StopIteration):
+            break
+        text = text.strip(" \n")
         split_text = text.split(" ")
         command = split_text[0]
         if command == "quit":
             break
-        elif command == "log":
-            mysite.log()
-            
-        elif command == "projects":
-            mysite.projects()
-            
-        elif command == "list" and len(split_text) == 2:
-            mysite.list_out(split_text[1])
-            
-        elif command == "create" and len(split_text) == 3:
-            myproposer.create_project(split_text[1], int(split_text[2]))
-            
-        elif command == "pledge" and len(split_text) == 3:
-            myproposer.create_pledge(split_text[2], split_text[1])
-            
-        elif command == "withdraw" and len(split_text) == 2:
-            myproposer.withdraw_pledge(split_text[1])
-            
-        elif command == "cancel" and len(split_text) == 2:
-            myproposer.cancel_project(split_text[1])
-            
+        elif parse(text) != None:
+            future = client.submit(text)
+            if source == None:
+                show(future.result())
+            else:
+                future.add_done_callback(lambda future: show(future.result()))
+            continue
+
+        # Everything else runs once the commands before it are done
+        client.drain()
+        if command == "wait":
+            pass
+
+        elif command == "echo":
+            # Lets a script see when every command before it is done
+            print(" ".join(split_text[1:]))
+
+        elif command == "stats":
+            shards.report_stats()
+
+        elif command == "trace" and (len(split_text) == 1 or len(split_text) == 2 and split_text[1].isdigit()):
+            # Recent events from the ring, the file gets flushed too so trace_merge sees them
+            last = int(split_text[1]) if len(split_text) == 2 else None
+            for line in shards.trace(last):
+                print(line)
+            shards.flush_traces()
+
+        elif command == "trace" and len(split_text) == 2 and split_text[1] in LEVELS:
+            shards.set_trace_level(split_text[1])
+
         elif command == "debug":
-            mysite.debug()
+            shards.debug()
 
         elif command == "rm" and len(split_text) == 2:
-            mysite.remove_log_entry(int(split_text[1]))
+            shards.remove_log_entry(int(split_text[1]))
             
         else:
             print("Check your input!")
 
+    client.close()
+    stats = shards.dump_stats()
+    shards.close()
+    logging.info(f"Stats: {json.dumps(stats)}")
+
     sys.exit()
 
 if __name__ == "__main__":
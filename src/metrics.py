@@ -0,0 +1,98 @@
+import time
+from bisect import bisect_left
+from collections import defaultdict
+
+# Bucket upper bounds in ms, each about 19% above the last, from 0.05 ms to roughly 50 s
+BOUNDS = [0.05 * 2 ** (i / 4) for i in range(81)]
+
+class Histogram():
+    def __init__(self):
+        self.buckets = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def observe(self, ms):
+        self.buckets[bisect_left(BOUNDS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile, never above the largest value seen
+        if not self.count:
+            return 0
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return min(BOUNDS[i] if i < len(BOUNDS) else self.max, self.max)
+        return self.max
+
+    def merge(self, other):
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def dump(self):
+        return {
+            "count": self.count,
+            "mean" : round(self.total / self.count, 3) if self.count else 0,
+            "p50"  : round(self.percentile(50), 3),
+            "p99"  : round(self.percentile(99), 3),
+            "max"  : round(self.max, 3),
+            "buckets": {i: n for i, n in enumerate(self.buckets) if n} # Only the ones in use, so dumps can be added up
+            }
+
+class Metrics():
+    # Counters, latency histograms in ms and gauges read when dumped. Only touched from the site's event loop.
+    def __init__(self):
+        self.counters = defaultdict(int)
+        self.histograms = defaultdict(Histogram)
+        self.gauges = {} # key: name. value: function returning the current value
+
+    def incr(self, name, n=1):
+        self.counters[name] += n
+
+    def observe(self, name, ms):
+        self.histograms[name].observe(ms)
+
+    def since(self, name, start):
+        # start comes from time.perf_counter()
+        self.observe(name, (time.perf_counter() - start) * 1000)
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def export(self):
+        # Picklable copy for another process, with the gauges already read
+        return dict(self.counters), dict(self.histograms), {name: fn() for name, fn in self.gauges.items()}
+
+    def merge(self, exported):
+        # Adds up counters and histograms from export(). Gauges keep the value they were exported with.
+        counters, histograms, gauges = exported
+        for name, n in counters.items():
+            self.counters[name] += n
+        for name, h in histograms.items():
+            self.histograms[name].merge(h)
+        for name, value in gauges.items():
+            self.gauge(name, lambda value=value: value)
+
+    def dump(self):
+        return {
+            "counters"  : dict(sorted(self.counters.items())),
+            "gauges"    : {name: fn() for name, fn in sorted(self.gauges.items())},
+            "histograms": {name: h.dump() for name, h in sorted(self.histograms.items())}
+            }
+
+    def report(self):
+        stats = self.dump()
+        for name, value in stats["gauges"].items():
+            print(f"{name:<24} {value}")
+        for name, value in stats["counters"].items():
+            print(f"{name:<24} {value}")
+        for name, h in stats["histograms"].items():
+            print(f"{name:<24} n={h['count']} mean={h['mean']}ms p50={h['p50']}ms p99={h['p99']}ms max={h['max']}ms")
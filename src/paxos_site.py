@@ -1,10 +1,25 @@
 from abc import ABC, abstractmethod
+import asyncio
 import logging, sys
 import sys
 import json
 import os.path
+import shutil
+import time
+import zlib
 from collections import defaultdict
-from consts import UserAction
+from consts import UserAction, DEFAULT_CONFIG
+from wal import WriteAheadLog
+from codec import ballot
+from gaps import GapIndex
+from state import CrowdfundState
+from acceptor_state import AcceptorState
+from metrics import Metrics
+from tracing import Tracer
+
+# Ports of one Paxos group: proposer, acceptor, learner, and the site's stats port in group 0's block.
+# Group g of a site uses the block starting at udp_start_port + GROUP_PORTS * g.
+GROUP_PORTS = 4
 
 class AbstractSite(ABC):
     def __init__():
@@ -23,14 +38,32 @@ class AbstractSite(ABC):
         pass
 
 
+def load_knownhosts():
+    # Our site name, every host and the cluster config with defaults filled in
+    site_name = sys.argv[1] if len(sys.argv) != 1 else "alpha"
+    with open("knownhosts.json") as f:
+        knownhosts = json.load(f)
+    config = dict(DEFAULT_CONFIG)
+    config.update(knownhosts.get("config", {}))
+    return site_name, knownhosts["hosts"], config
+
+class Counters(dict):
+    # Pledge and proposal counters of a site running in one process
+    def take(self, name):
+        # Hands out the current value and moves the counter on
+        value = self[name]
+        self[name] = value + 1
+        return value
+
 class Site(AbstractSite):
-    def __init__(self):
-        # Site initialization
-        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
-        site_name = sys.argv[1] if len(sys.argv) != 1 else "alpha"
+    def __init__(self, group=0, counters=None, metrics=None, knownhosts=None, storage=WriteAheadLog):
+        # Site initialization. The groups of a site running in one process share counters and metrics.
+        # knownhosts is what load_knownhosts returns, read from the files by default. storage is the WAL class.
+        start_time = time.perf_counter()
+        self.knownhosts = knownhosts
+        self.storage = storage
+        site_name, site_dict, self.config = knownhosts or load_knownhosts()
         self.site_name = site_name
-        with open("knownhosts.json") as f:
-            site_dict = json.load(f)["hosts"]
         count = 0
         new_site_dict = {}
         for key in site_dict:
@@ -43,150 +76,376 @@ class Site(AbstractSite):
         self.site_dict = new_site_dict
         self.num_sites = len(site_dict)
         self.majority = self.num_sites // 2 + 1
+        self.group = group
+        if self.port(self.site_id, 2) > self.site_dict[self.site_id]["udp_end_port"]:
+            raise Exception(f"Group {group} needs ports up to {self.port(self.site_id, 2)}, past udp_end_port")
+        self.group_suffix = f".g{group}" if group else ""
+        suffix = self.group_suffix
 
         # Crowdfund values
-        self.crowdfund = {} # key: project_name. value: funding_goal
-        self.pledges   = defaultdict(list) # key: project_name. value: list of pledges to project_name
-        self.cancelled_projects = []
-        self.cancelled_pledges = []
-        self.ghost_pledged = defaultdict(list)
-
-        log_file = f"logs/paxos_log{self.site_id}.json"
-        if os.path.isfile(log_file) and "debug" not in sys.argv:
-            with open(log_file, 'r') as openfile:
-                json_obj = json.load(openfile)
-                self.p_log = json_obj["p_log"]
-                self.pledge_counter = json_obj["pledge_counter"]
-                self.proposal_counter = json_obj["proposal_counter"]
-                self.max_prop_num = defaultdict(lambda: float(f"1.{self.site_id}"))
-                # It's fucking ugly and idc care more
-                # Needs the key to be integers!
-                for k, v in json_obj["max_prop_num"].items():
-                    self.max_prop_num[int(k)] = v
-
-                self.max_prepare = defaultdict(int, json_obj["max_prepare"])
-                for k, v in json_obj["max_prepare"].items():
-                    self.max_prepare[int(k)] = v
-
-                self.accepted_num = defaultdict(lambda: None, json_obj["accepted_num"])
-                for k, v in json_obj["accepted_num"].items():
-                    self.accepted_num[int(k)] = v
-
-                self.accepted_val = defaultdict(lambda: None, json_obj["accepted_val"])
-                for k, v in json_obj["accepted_val"].items():
-                    self.accepted_val[int(k)] = v
-
-                self.holes = set(json_obj["holes"])
-                logging.info(f"Site {self.site_name} loaded")
-            # TODO: Refactor this
-            for entry in self.p_log[:-1]:
-                # p_log guarentees validity
-                action = entry["action"]
-                if action == UserAction.CREATE_PROJECT:
-                    self.crowdfund[entry["project_name"]] = entry["funding_goal"]
-                elif action == UserAction.CREATE_PLEDGE:
-                    self.pledges[entry["project_name"]].append([entry["pledge_id"], entry["site_name"]])
-                elif action == UserAction.WITHDRAW_PLEDGE:
-                    old = self.pledges[entry["project_name"]]
-                    new = []
-                    for k in old:
-                        if k[0] != entry["pledge_id"]:
-                            new.append(k)
-                    self.pledges[entry["project_name"]] = new
-                elif action == UserAction.CANCEL_PROJECT:
-                    del self.pledges[entry["project_name"]]
-                    del self.crowdfund[entry["project_name"]]
+        self.state = CrowdfundState()
+
+        # Pledge ids have to be unique across groups, so every group of a site draws from the same counters
+        self.counters = counters if counters != None else Counters(pledge=1, proposal=0)
+
+        # Proposer Values
+        # Note: Proposal numbers are ballots packing a round and our site_id, see codec.ballot
+        self.max_prop_num = defaultdict(lambda: ballot(1, self.site_id))
+        
+        # Acceptor Values
+        self.acceptor_state = AcceptorState()
+
+        # Learner Values
+        self.p_log = [None] # There's always an empty 'hole' at the end of the list for future proposals
+        self.gaps = GapIndex() # Slots we haven't learned yet
+        self.log_base = 0 # Slot of p_log[0]. Everything below it has been compacted into the snapshot
+        self.applied_slot = -1 # Crowdfund values reflect every slot up to this one
+        self.apply_waiters = [] # (index, asyncio.Event) of readers waiting until every slot below index is applied
+
+        # Snapshot values
+        self.snapshot_file = f"logs/snapshot{self.site_id}{suffix}.json"
+        self.snapshot_slot = -1 # Last slot the snapshot covers
+        self.snapshot_blob = None # Last written snapshot, served to lagging sites
+        self.snapshot_version = 0 # crc32 of snapshot_blob, so a site fetching it in chunks notices when it is replaced
+        self.learned_since_snapshot = 0
+        self.peer_watermarks = {} # key: site_id. value: first slot that site has not learned yet
+        self.reported_cluster_watermark = 0 # Highest cluster_watermark a peer told us about
+        self.waiters = {} # key: proposal_id. value: PendingAction waiting for the learner's outcome
+
+        # Counters and histograms add up over groups, gauges are per group
+        self.metrics = metrics if metrics != None else Metrics()
+        prefix = f"g{group}." if group else ""
+        self.metrics.gauge(prefix + "log_length", self.cur_log_slot)
+        self.metrics.gauge(prefix + "applied_slot", lambda: self.applied_slot)
+        self.metrics.gauge(prefix + "snapshot_slot", lambda: self.snapshot_slot)
+        self.metrics.gauge(prefix + "entries_in_memory", lambda: len(self.p_log) - 1)
+        self.metrics.gauge(prefix + "holes", lambda: len(self.gaps))
+        self.metrics.gauge(prefix + "leader_id", lambda: self.acceptor_state.leader_id)
+        self.metrics.gauge(prefix + "acceptor_entries", lambda: len(self.acceptor_state))
+
+        trace_file = f"logs/trace{self.site_id}{suffix}.bin" if self.config["trace_file"] else None
+        self.tracer = Tracer(self.site_id, self.site_name + suffix, self.config["trace_level"], self.config["trace_ring"], trace_file)
+
+        wal_dir = f"logs/wal{self.site_id}{suffix}"
+        if "debug" in sys.argv:
+            shutil.rmtree(wal_dir, ignore_errors=True)
+            if os.path.isfile(self.snapshot_file):
+                os.remove(self.snapshot_file)
+        self.wal = storage(wal_dir, self.config["wal_segment_bytes"], self.config["wal_group_commit_ms"])
+        if os.path.isfile(self.snapshot_file):
+            with open(self.snapshot_file, "r") as openfile:
+                self.snapshot_blob = openfile.read()
+            self.snapshot_version = zlib.crc32(self.snapshot_blob.encode("utf-8"))
+            snapshot = json.loads(self.snapshot_blob)
+            self.load_snapshot(snapshot)
+            self.load_acceptor_snapshot(snapshot)
+            self.load_counters(snapshot)
+        # Only the snapshot and the WAL written after it are read, and only slots past the snapshot are applied
+        loaded = self.snapshot_blob or self.wal.segments()
+        for record in self.wal.replay():
+            self.replay_record(record)
+        self.wal.open()
+        replayed = self.apply_ready()
+        elapsed = (time.perf_counter() - start_time) * 1000
+        if loaded:
+            logging.info(f"Site {self.site_name}{suffix} loaded in {elapsed:.1f} ms, snapshot at slot {self.snapshot_slot}, applied {replayed} slots past it")
+        else:
+            logging.info(f"Site {self.site_name}{suffix} started")
+
+    def replay_record(self, record):
+        kind = record["type"]
+        if kind == "learn":
+            if record["slot"] > self.snapshot_slot:
+                self.safe_add_log(record["val"], record["slot"])
+            self.load_counters(record)
+        elif kind == "promise":
+            self.acceptor_state.promise(record["slot"], record["num"])
+        elif kind == "leader_promise":
+            self.acceptor_state.promise_from(record["num"], record["from_slot"], record["leader_id"])
+        elif kind == "accept":
+            self.acceptor_state.accept(record["slot"], record["num"], record["val"])
+
+    @property
+    def pledge_counter(self):
+        return self.counters["pledge"]
+
+    @pledge_counter.setter
+    def pledge_counter(self, value):
+        self.counters["pledge"] = value
+
+    @property
+    def proposal_counter(self):
+        return self.counters["proposal"]
+
+    @proposal_counter.setter
+    def proposal_counter(self, value):
+        self.counters["proposal"] = value
+
+    def load_counters(self, saved):
+        # Counters only grow. Another group may already have loaded a later value.
+        self.pledge_counter = max(self.pledge_counter, saved["pledge_counter"])
+        self.proposal_counter = max(self.proposal_counter, saved["proposal_counter"])
+
+    def port(self, site_id, offset):
+        # offset 0 is the proposer, 1 the acceptor, 2 the learner
+        return self.site_dict[site_id]["udp_start_port"] + GROUP_PORTS * self.group + offset
+
+    def learn(self, val, slot):
+        # Returns whether slot was new to us
+        if self.is_learned(slot):
+            self.metrics.incr("learner.duplicates")
+            return False
+        self.metrics.incr("learner.learned")
+        self.safe_add_log(val, slot)
+        self.write_log(slot)
+        self.apply_ready()
+        return True
+
+    def apply(self, entry, slot):
+        # The one path from a learned slot to the crowdfund state, used by the learner and on startup
+        actions = entry["actions"] if entry["action"] == UserAction.BATCH else [entry]
+        for action in actions:
+            applied = self.state.apply(action)
+            pending = self.waiters.pop(action.get("proposal_id"), None)
+            if pending:
+                pending.resolve(True, applied, slot)
+
+    def apply_ready(self):
+        # Slots can be learned in any order, but are applied strictly in slot order. Returns how many were applied.
+        count = 0
+        while self.applied_slot + 1 < self.cur_log_slot():
+            self.applied_slot += 1
+            self.apply(self.get_entry(self.applied_slot), self.applied_slot)
+            count += 1
+            self.maybe_snapshot()
+        if count:
+            self.collect_acceptor_state()
+        if self.apply_waiters:
+            self.notify_applied()
+        return count
 
+    def applied_event(self, index):
+        # Set once every slot below index is applied
+        event = asyncio.Event()
+        if self.applied_slot + 1 >= index:
+            event.set()
         else:
-            self.pledge_counter = 1
-            self.proposal_counter = 0
-
-            # Proposer Values
-            # Note: Local max_prop_num is int, but turns into float when sending. 
-            #       In the format of {max_prop_num}.{site_id}. For example, 
-            #       max_prop_num = 5 and site_it = 2 turns into 5.2
-            self.max_prop_num = defaultdict(lambda: float(f"1.{self.site_id}"))
-            
-            # Acceptor Values
-            # Note: All three dicts should have the same key at all time!
-            self.max_prepare = defaultdict(int)
-            self.accepted_num = defaultdict(lambda: None)
-            self.accepted_val = defaultdict(lambda: None)
-
-            # Learner Values
-            self.p_log = [None] # There's always an empty 'hole' at the end of the list for future proposals
-            self.holes = set([0])  # Set of integers. Keeps track of all the holes, since it's a set it's in assending order.
-
-            logging.info(f"Site {self.site_name} started")
+            self.apply_waiters.append((index, event))
+        return event
+
+    def notify_applied(self):
+        waiting = []
+        for index, event in self.apply_waiters:
+            if self.applied_slot + 1 >= index:
+                event.set()
+            else:
+                waiting.append((index, event))
+        self.apply_waiters = waiting
+
+    def cluster_watermark(self):
+        # Every site has learned every slot below this one
+        # A leader hears from everyone, followers mostly hear from the leader, so they also take its word for it
+        watermarks = [self.peer_watermarks.get(i, 0) for i in self.site_dict if i != self.site_id]
+        return max(min(watermarks + [self.cur_log_slot()]), self.reported_cluster_watermark)
+
+    def collect_acceptor_state(self):
+        watermark = self.cluster_watermark()
+        if watermark <= self.acceptor_state.floor:
+            return
+        collected = self.acceptor_state.collect(watermark)
+        if collected:
+            self.metrics.incr("acceptor.collected", collected)
+        # Our proposer's ballots for those slots can go too, nobody proposes there again
+        for slot in [s for s in self.max_prop_num if s < watermark]:
+            del self.max_prop_num[slot]
+
+    def load_snapshot(self, snapshot):
+        self.state.load(snapshot)
+        self.snapshot_slot = snapshot["last_slot"]
+        self.applied_slot = self.snapshot_slot
+        self.log_base = snapshot["log_base"]
+        self.p_log = snapshot["p_log"] + [None]
+        self.gaps = GapIndex(self.log_base)
+        for i, entry in enumerate(snapshot["p_log"]):
+            if entry != None:
+                self.gaps.fill(self.log_base + i)
+
+    def load_acceptor_snapshot(self, snapshot):
+        self.acceptor_state.load(snapshot["acceptor"])
+
+    def maybe_snapshot(self):
+        # Called after each applied slot, so the state is exactly the result of every slot up to applied_slot
+        self.learned_since_snapshot += 1
+        if self.learned_since_snapshot >= self.config["snapshot_interval"]:
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        # Records appended after the checkpoint are replayed on top of the snapshot, and replaying them twice is harmless
+        wal_segment = self.wal.checkpoint()
+        self.compact()
+        last_slot = self.applied_slot
+        snapshot = {
+            "last_slot"         : last_slot,
+            "log_base"          : self.log_base,
+            "p_log"             : self.p_log[:-1], # Learned but not yet applied entries ride along
+            "pledge_counter"    : self.pledge_counter,
+            "proposal_counter"  : self.proposal_counter,
+            "acceptor"          : self.acceptor_state.dump()
+            }
+        snapshot.update(self.state.dump())
+        blob = json.dumps(snapshot)
+        tmp_file = self.snapshot_file + ".tmp"
+        with open(tmp_file, "w") as openfile:
+            openfile.write(blob)
+            openfile.flush()
+            os.fsync(openfile.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        self.wal.drop_before(wal_segment)
+        self.snapshot_blob = blob
+        self.snapshot_version = zlib.crc32(blob.encode("utf-8"))
+        self.snapshot_slot = last_slot
+        self.learned_since_snapshot = 0
+        logging.info(f"Site {self.site_name}{self.group_suffix} wrote snapshot up to slot {last_slot}, log starts at {self.log_base}")
+
+    def install_snapshot(self, snapshot):
+        # Snapshot from a peer. Acceptor promises and counters stay our own.
+        self.load_snapshot(snapshot)
+        self.apply_ready()
+        self.write_snapshot()
+        logging.info(f"Site {self.site_name}{self.group_suffix} installed snapshot up to slot {self.snapshot_slot}")
+
+    def compact(self):
+        # Drop entries that every site has learned and the snapshot about to be written covers
+        new_base = min(self.cluster_watermark(), self.applied_slot + 1)
+        if new_base > self.log_base:
+            del self.p_log[:new_base - self.log_base]
+            self.log_base = new_base
+
+    def get_entry(self, slot):
+        return self.p_log[slot - self.log_base]
+
+    def is_learned(self, slot):
+        if slot < self.log_base:
+            return True
+        return slot - self.log_base < len(self.p_log) and self.p_log[slot - self.log_base] != None
 
     def debug(self):
-        print(self.p_log, self.cur_log_slot())
+        print(self.log_base, self.p_log, self.cur_log_slot())
 
     def remove_log_entry(self, slot):
         # DEBUG FUNCTION DO NOT USE
-        self.holes.add(slot)
-        self.p_log[slot] = None
-
-    def write_log(self):
-        log_file = f"logs/paxos_log{self.site_id}.json" 
-        os.makedirs(os.path.dirname(log_file), exist_ok=True)
-        with open(log_file, "w") as openfile:
-            #TODO: Don't need to open everytime you learn
-            dictionary = {
-                "p_log"           : self.p_log,
-                "max_prop_num"    : self.max_prop_num,
-                "max_prepare"     : self.max_prepare,
-                "accepted_num"    : self.accepted_num,
-                "accepted_val"    : self.accepted_val,
-                "holes"           : list(self.holes),
-                "pledge_counter"  : self.pledge_counter,
-                "proposal_counter": self.proposal_counter
-                }
-            json.dump(dictionary, openfile)
-            openfile.close()
+        self.gaps.open(slot)
+        self.p_log[slot - self.log_base] = None
+
+    def write_log(self, slot):
+        # Learned entries can be recovered from peers, so nobody waits for them to be durable
+        start = time.perf_counter()
+        lsn = self.wal.append({
+            "type"            : "learn",
+            "slot"            : slot,
+            "val"             : self.p_log[slot - self.log_base],
+            "pledge_counter"  : self.pledge_counter,
+            "proposal_counter": self.proposal_counter
+            }, sync=False)
+        self.metrics.since("write_log", start)
+        return lsn
+
+    def write_promise(self, slot):
+        # The acceptor waits for these to be durable before it replies
+        return self.wal.append({
+            "type": "promise",
+            "slot": slot,
+            "num" : self.acceptor_state.promised_num(slot)
+            }, sync=False)
+
+    def write_leader_promise(self):
+        return self.wal.append({
+            "type"     : "leader_promise",
+            "num"      : self.acceptor_state.promised,
+            "from_slot": self.acceptor_state.promised_from,
+            "leader_id": self.acceptor_state.leader_id
+            }, sync=False)
+
+    def write_accept(self, slot):
+        return self.wal.append({
+            "type": "accept",
+            "slot": slot,
+            "num" : self.acceptor_state.accepted_at(slot)[0],
+            "val" : self.acceptor_state.accepted_at(slot)[1]
+            }, sync=False)
 
     def list_out(self, project):
-        proj_pledges = self.pledges.get(project)
-        if proj_pledges != None:
-            for pledge in proj_pledges:
-                print(pledge[0], pledge[1])
+        for line in self.pledge_lines(project):
+            print(line)
+
+    def pledge_lines(self, project, offset=0, count=None):
+        proj_pledges = self.state.list_pledges(project, offset, count)
+        if proj_pledges == None:
+            return []
+        return [f"{pledge[0]} {pledge[1]}" for pledge in proj_pledges]
 
     def projects(self):
-        for project in sorted(self.crowdfund.keys()):
+        for project, funding_goal, status in self.project_rows():
+            print(project, funding_goal, status)
+
+    def project_rows(self, count=None, after=None):
+        # Up to count projects in name order, starting after the name given
+        rows = []
+        for project in self.state.project_names(after, count):
             status = "unfunded"
-            if self.crowdfund.get(project) == len(self.pledges.get(project))*100:
+            if self.state.is_funded(project):
                 status = "funded"
-            print(project, self.crowdfund.get(project), status)
+            rows.append((project, self.state.funding_goal(project), status))
+        return rows
 
     def log(self):
-        for entry in self.p_log[:-1]:
-            sentence = ""
-            if not entry:
-                sentence = "missing entry"
-            elif entry["action"] == UserAction.CREATE_PROJECT:
-                sentence = "create_project " + entry["project_name"] + " " + entry["proposal_id"].rsplit('_')[0] + " " + str(entry["funding_goal"])
-            elif entry["action"] == UserAction.CREATE_PLEDGE:
-                sentence = "make_pledge " + entry["pledge_id"] + " " + entry["project_name"] + " " + entry["proposal_id"].rsplit('_')[0]
-            elif entry["action"] == UserAction.CANCEL_PROJECT:
-                sentence = "cancel_project " + entry["project_name"]
-            elif entry["action"] == UserAction.WITHDRAW_PLEDGE:
-                sentence = "withdraw_pledge " + entry["pledge_id"]
-            print(sentence)
-                
+        for line in self.log_lines():
+            print(line)
+
+    def log_lines(self, from_slot=None, to_slot=None):
+        # Entries of slots in [from_slot, to_slot), the whole log we still have by default. Compacted slots are gone.
+        lines = []
+        end = self.log_base + len(self.p_log) - 1
+        if to_slot != None:
+            end = min(end, to_slot)
+        for slot in range(self.log_base if from_slot == None else max(from_slot, self.log_base), end):
+            batch = self.get_entry(slot)
+            entries = batch["actions"] if batch and batch["action"] == UserAction.BATCH else [batch]
+            for entry in entries:
+                sentence = self.log_entry(entry)
+                if sentence != None:
+                    lines.append(sentence)
+        return lines
+
+    def log_entry(self, entry):
+        sentence = ""
+        if not entry:
+            sentence = "missing entry"
+        elif entry["action"] == UserAction.CREATE_PROJECT:
+            sentence = "create_project " + entry["project_name"] + " " + entry["proposal_id"].rsplit('_')[0] + " " + str(entry["funding_goal"])
+        elif entry["action"] == UserAction.CREATE_PLEDGE:
+            sentence = "make_pledge " + entry["pledge_id"] + " " + entry["project_name"] + " " + entry["proposal_id"].rsplit('_')[0]
+        elif entry["action"] == UserAction.CANCEL_PROJECT:
+            sentence = "cancel_project " + entry["project_name"]
+        elif entry["action"] == UserAction.WITHDRAW_PLEDGE:
+            sentence = "withdraw_pledge " + entry["pledge_id"]
+        elif entry["action"] == UserAction.NOOP:
+            return None
+        return sentence
 
     def safe_add_log(self, val, slot):
-        if len(self.p_log) - 1 <= slot:
-            for h in range(len(self.p_log), slot + 2):
-                if h != slot:
-                    self.holes.add(h)
-            self.p_log.extend([None for _ in range(slot - len(self.p_log) + 2)])
-        if slot in self.holes:
-            self.holes.remove(slot)
-        self.p_log[slot] = val
+        index = slot - self.log_base
+        if index < 0:
+            # Already compacted
+            return
+        if len(self.p_log) - 1 <= index:
+            self.p_log.extend([None] * (index - len(self.p_log) + 2))
+        self.gaps.fill(slot)
+        self.p_log[index] = val
 
     def cur_log_slot(self):
-        # Return the slot for the next proposal
-        return min(self.holes)
+        # Return the slot for the next proposal. Everything below it is learned.
+        return self.gaps.watermark()
 
 class AbstractSiteDecorator():
     def __init__(self, decorated_site):
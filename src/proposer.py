@@ -1,114 +1,333 @@
-import logging, sys
-import time
+import logging
+import asyncio
 import json
-import threading, queue
-import socket
+import random
+import time
 from consts import PaxosEvent, UserAction
 from paxos_site import AbstractSiteDecorator
+from codec import ballot, next_ballot
+from runtime import ResponseTimes
+from learner import fetch_range
 from collections import defaultdict
 
+# Unacknowledged COMMITs are sent again after COMMIT_TIMEOUT seconds, doubling each time
+COMMIT_TIMEOUT = 0.05
+COMMIT_RETRIES = 3
+
+# Thrifty rounds widen to every peer once the chosen ones are overdue, after THRIFTY_MIN_WAIT seconds at least
+THRIFTY_MIN_WAIT = 0.01
+THRIFTY_REFRESH = 32
+
+# A round gives up once the replies it needs are overdue by the peers' response times, within these bounds in seconds
+QUORUM_TIMEOUT_MIN = 0.05
+QUORUM_TIMEOUT = 2
+
+# Lost rounds back off for a random time of up to a round trip, doubling with every round lost, at most BACKOFF_MAX seconds.
+# A proposal gives up after NACK_BUDGET rounds in a row lost to higher ballots, or TIMEOUT_BUDGET rounds nobody answered.
+BACKOFF_MIN = 0.005
+BACKOFF_MAX = 1
+NACK_BUDGET = 8
+TIMEOUT_BUDGET = 3
+
+# Unanswered FORWARDs are sent again with the wait doubling, at least FORWARD_RETRIES times and until the leader has been silent for a lease.
+# The leader remembers forwarded proposals for FORWARD_KEEP seconds after they finish, so a resent one gets the same answer.
+FORWARD_RETRIES = 3
+FORWARD_KEEP = 10
+
 class Proposer(AbstractSiteDecorator):
-    def __init__(self, decorated_site):
+    def __init__(self, decorated_site, runtime):
         super().__init__(decorated_site)
-        self.port = self.decorated_site.site_dict[self.decorated_site.site_id]["udp_start_port"]
-        logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
-        
+        self.runtime = runtime
+        self.port = self.decorated_site.port(self.decorated_site.site_id, 0)
+
+        # Multi-Paxos leader values
+        self.is_leader = False
+        self.leader_prop_num = ballot(1, self.decorated_site.site_id)
+        self.next_slot = 0 # Never propose into a slot we already committed or sent a leader accept for
+        self.commit_index = 0 # One past the highest slot we committed
+        # Read lease. The acceptors start counting their grant when our round reaches them, so ours runs out first.
+        # The last 10% is left as slack for clock drift.
+        config = self.decorated_site.config
+        self.lease_time = config["lease_ms"] / 1000 if config["leader_mode"] else 0
+        self.lease_until = 0
+        self.leader_lock = asyncio.Lock()
+        self.forwarded = {} # key: proposal_id. value: task proposing what a follower forwarded
+        self.leader_hint = None # Leader whose lease an acceptor turned our prepare_all down for
+        self.metrics = self.decorated_site.metrics
+        self.tracer = self.decorated_site.tracer
+
+        self.batch_queue = asyncio.Queue()
+
+        # Pipelining values
+        self.inflight = set() # Slots our proposals are working on right now
+        self.window = asyncio.BoundedSemaphore(self.decorated_site.config["pipeline_window"])
+
+        # Thrifty rounds go to our own acceptor and the fastest peers that make a majority with it
+        self.thrifty = config["thrifty"]
+        self.response_times = ResponseTimes()
+        self.rounds = 0
+
+    async def start(self):
         # Recovery 
         obj = {
             "event"     : PaxosEvent.SEEK
             }
-        res, _ = self.send_to_majority(obj, port_offset=2)
+        res, _ = await self.send_to_majority(obj, port_offset=2)
+        for r in res:
+            if r.get("log_base", 0) > self.decorated_site.cur_log_slot():
+                # Peer already compacted slots we are missing
+                try:
+                    await self.fetch_snapshot(r["origin"])
+                    break
+                except Exception as e:
+                    logging.info(f"exception while fetching snapshot from {r['origin']}, {e}")
         max_slot = self.decorated_site.cur_log_slot()
         for r in res:
             max_slot = max(r["cur_slot"], max_slot)
-        for i in range(self.decorated_site.cur_log_slot() + 1, max_slot + 1):
-            self.decorated_site.holes.add(i)
+        # Slots below a peer's cur_slot were chosen there, the ones we don't have become gaps to fill
+        self.decorated_site.gaps.extend_to(max_slot)
+        # Copy what peers already learned, Paxos only runs for what none of them has
+        await self.catch_up([r["origin"] for r in sorted(res, key=lambda r: r["cur_slot"], reverse=True)])
 
         try:
-            self.fill_hole()
+            await self.fill_hole()
         except Exception as e:
             logging.info(f"exceiption while filling holes, {e}")
 
+        if self.decorated_site.config["batch_size"] > 1:
+            asyncio.ensure_future(self.batcher())
+        if self.lease_time:
+            asyncio.ensure_future(self.renew_lease())
 
-    def send_to_majority(self, obj, port_offset=1):
-        counter = Counter(self.decorated_site.majority)
-        resQ = queue.Queue()
-        threads = []
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        def send_helper(destination, obj, counter):
-            addr = (self.decorated_site.site_dict[destination]["ip_address"], \
-                    self.decorated_site.site_dict[destination]["udp_start_port"] + port_offset) 
-            client_socket.sendto(json.dumps(obj).encode("utf-8"), addr)
-            try:
-                if counter.reached_target():
-                    # Already reached majority, no further need
-                    return
-                client_socket.settimeout(0.2)
-                message, _ = client_socket.recvfrom(32768)
-                decoded_message = json.loads(message.decode("utf-8"))
-                counter.increse()
-                resQ.put(decoded_message)
-                resQ.task_done()
-            except:
-                return
+    def handle(self, decoded_message):
+        event = decoded_message["event"]
+        if event == PaxosEvent.FORWARD:
+            return self.handle_forward(decoded_message["propose_val"])
+        elif event == PaxosEvent.READ_INDEX:
+            return self.handle_read_index()
+        raise Exception("Unknown event for proposer!")
 
-        for k in self.decorated_site.site_dict.keys():
-            pass_arg = [k, obj, counter]
-            t = threading.Thread(target=send_helper, daemon=True, args=(*pass_arg,))
-            t.start()
-            threads.append(t)
-        
-        start = time.time()
-        while not counter.reached_target():
-            if time.time() - start > 2:
-                # Two second timeout
+    def handle_read_index(self):
+        # Only a leaseholder knows nothing was committed behind its back
+        if not self.has_lease():
+            return {
+                "origin": self.decorated_site.site_id,
+                "event" : PaxosEvent.NACK
+                }
+        return {
+            "origin": self.decorated_site.site_id,
+            "event" : PaxosEvent.ACK,
+            "index" : max(self.commit_index, self.decorated_site.cur_log_slot())
+            }
+
+    async def handle_forward(self, proposed_value):
+        # A follower resends a FORWARD it got no answer to. The proposal id ties it to the proposal already running.
+        proposal_id = proposed_value["proposal_id"]
+        proposal = self.forwarded.get(proposal_id)
+        if proposal == None:
+            proposal = asyncio.ensure_future(self.propose_multi(proposed_value, forwarded=True))
+            self.forwarded[proposal_id] = proposal
+            proposal.add_done_callback(lambda _: self.runtime.loop.call_later(FORWARD_KEEP, self.forwarded.pop, proposal_id, None))
+        else:
+            self.metrics.incr("forward.duplicates")
+        holder = None
+        try:
+            slot = await asyncio.shield(proposal)
+            if slot == None:
+                holder = self.leader_hint
+        except Exception as e:
+            self.tracer.info("forward_failed", error=str(e))
+            slot = None
+        return {
+            "origin"      : self.decorated_site.site_id,
+            "event"       : PaxosEvent.ACK,
+            "committed"   : slot != None,
+            "log_slot"    : slot,
+            "lease_holder": holder # Set if we never proposed it because this site holds the lease instead
+            }
+
+    def listen(self):
+        self.runtime.serve("Proposer", self.port, self.handle)
+
+    def address(self, site_id, port_offset):
+        return (self.decorated_site.site_dict[site_id]["ip_address"], self.decorated_site.port(site_id, port_offset))
+
+    async def fetch_snapshot(self, peer, max_try=3):
+        addr = self.address(peer, 2)
+        chunks = []
+        offset = 0
+        total = None
+        version = None
+        tries = 0
+        while total == None or offset < total:
+            obj = {
+                "event" : PaxosEvent.SNAPSHOT,
+                "offset": offset
+                }
+            res = await self.runtime.request(obj, [addr], 1, 0.5)
+            if not res:
+                tries += 1
+                if tries >= max_try:
+                    raise Exception("Max number of tries exceeded")
+                continue
+            decoded_message = res[0]
+            if version != None and decoded_message["version"] != version:
+                # Peer wrote a newer snapshot meanwhile, start over on that one
+                self.metrics.incr("snapshot.restarts")
+                tries += 1
+                if tries >= max_try:
+                    raise Exception("Snapshot kept changing during transfer")
+                chunks = []
+                offset = 0
+                total = None
+                version = None
+                continue
+            version = decoded_message["version"]
+            total = decoded_message["total"]
+            chunks.append(decoded_message["data"])
+            offset += len(decoded_message["data"])
+        self.decorated_site.install_snapshot(json.loads("".join(chunks)))
+
+    async def catch_up(self, peers):
+        # Streams learned entries for every gap from peers, most up to date first. Rejoin cost is bytes, not rounds.
+        site = self.decorated_site
+        start = time.perf_counter()
+        for peer in peers:
+            if peer == site.site_id:
+                continue
+            for gap_start, gap_end in site.gaps.ranges():
+                learned = await fetch_range(self.runtime, site, self.address(peer, 2), gap_start, gap_end)
+                self.metrics.incr("catch_up.entries", learned)
+            if not len(site.gaps):
                 break
-        for t in threads:
-            t.join()
+        self.metrics.since("catch_up", start)
+
+    def send(self, obj, site_id, port_offset):
+        # Fire and forget, our own roles get obj in-process
+        if site_id == self.decorated_site.site_id:
+            self.runtime.send_local(obj, self.decorated_site.port(site_id, port_offset))
+        else:
+            self.runtime.send(obj, self.address(site_id, port_offset))
+
+    def peers(self, port_offset):
+        return [self.address(k, port_offset) for k in self.decorated_site.site_dict if k != self.decorated_site.site_id]
+
+    def quorum_time(self, peers, floor, default):
+        # When the replies of the peers a majority needs, along with our own, are overdue
+        return self.response_times.timeout(peers, self.decorated_site.majority - 1, floor, default)
+
+    async def send_to_majority(self, obj, port_offset=1):
+        site = self.decorated_site
+        peers = self.peers(port_offset)
+        local = [site.port(site.site_id, port_offset)]
+        phase = PaxosEvent(obj["event"]).name.lower()
+        start = time.perf_counter()
+        self.rounds += 1
+        timeout = min(self.quorum_time(peers, QUORUM_TIMEOUT_MIN, QUORUM_TIMEOUT), QUORUM_TIMEOUT)
+        widen = None
+        if self.thrifty and port_offset == 1 and not obj.get("all_slots") and self.rounds % THRIFTY_REFRESH:
+            # Only the fastest peers first, the rest after they are overdue.
+            # Every THRIFTY_REFRESH-th round still goes to everyone, so every peer's time and watermark stay fresh.
+            # Leader elections always do, every acceptor has to learn who the leader is.
+            first = self.response_times.fastest(peers, site.majority - 1)
+            rest = [addr for addr in peers if addr not in first]
+            after = self.response_times.timeout(first, len(first), THRIFTY_MIN_WAIT, THRIFTY_MIN_WAIT)
+            widen = (rest, after)
+            timeout += after
+            peers = first
+        replies = await self.runtime.request(obj, peers, site.majority, timeout, local=local, widen=widen, times=self.response_times)
+        self.metrics.since(phase, start)
         res = []
         max_nack = 0
-        while not resQ.empty():
-            r = resQ.get()
+        for r in replies:
+            if "watermark" in r:
+                self.decorated_site.peer_watermarks[r["origin"]] = r["watermark"]
             if r["event"] != PaxosEvent.NACK:
                 res.append(r)
             else:
-                max_nack = max(max_nack, int(r["max_num"]))
-                
-        resQ.join()
-        # TODO: Don't change max_nack's suffix here maybe?
-        return (res, float(f"{max_nack}.{self.decorated_site.site_id}"))
+                max_nack = max(max_nack, r["max_num"])
+                self.metrics.incr(f"{phase}.nacks")
+                if r.get("lease_holder") not in (None, site.site_id):
+                    self.leader_hint = r["lease_holder"]
+        if len(replies) < self.decorated_site.majority:
+            self.metrics.incr(f"{phase}.timeouts")
+            answered = set(r.get("origin") for r in replies)
+            for site_id, site in self.decorated_site.site_dict.items():
+                if site_id not in answered:
+                    self.metrics.incr(f"timeouts.{site['site_name']}")
+        return (res, max_nack)
 
     def commit(self, val, log_slot):
         # Called when the proposer acts as Distinguished Learner
-        commit_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        for _, site in self.decorated_site.site_dict.items():
-            addr = (site["ip_address"], site["udp_start_port"] + 2) # +2 cuz it's the learners
-            obj = {
-                "event"     : PaxosEvent.COMMIT,
-                "commit_val": val,
-                "log_slot"  : log_slot
-                }
-            commit_socket.sendto(json.dumps(obj).encode("utf-8"), addr)
+        site = self.decorated_site
+        obj = {
+            "origin"           : site.site_id,
+            "event"            : PaxosEvent.COMMIT,
+            "commit_val"       : val,
+            "log_slot"         : log_slot,
+            "watermark"        : site.cur_log_slot(),
+            "cluster_watermark": site.cluster_watermark()
+            }
+        self.send(obj, site.site_id, 2) # +2 cuz it's the learners
+        asyncio.ensure_future(self.send_commit(obj, [k for k in site.site_dict if k != site.site_id]))
+        self.commit_index = max(self.commit_index, log_slot + 1)
 
-    def prepare(self, log_slot, try_num=0, max_try=3):
-        if try_num >= max_try:
-            raise Exception("Max number of tries exceeded")
-        logging.info(f"sending prepare({self.decorated_site.max_prop_num[log_slot]}) to slot {log_slot}")
+    async def send_commit(self, obj, peers):
+        # Learners ACK a COMMIT. Whoever hasn't after timeout gets it again, up to COMMIT_RETRIES times.
+        # A learner that misses all of them still finds the hole from the next ACCEPT or COMMIT and pulls the slot.
+        timeout = COMMIT_TIMEOUT
+        for attempt in range(COMMIT_RETRIES + 1):
+            if attempt:
+                self.metrics.incr("commit.retransmits", len(peers))
+            replies = await self.runtime.request(obj, [self.address(k, 2) for k in peers], len(peers), timeout)
+            for r in replies:
+                self.decorated_site.peer_watermarks[r["origin"]] = r["watermark"]
+            answered = set(r["origin"] for r in replies)
+            peers = [k for k in peers if k not in answered]
+            if not peers:
+                return
+            timeout *= 2
+
+    async def retry(self, budget, max_nack):
+        # Charges a lost round to budget, then backs off. Full jitter, so dueling proposers fall out of step.
+        lost = budget.lose(max_nack > 0)
+        cap = min(BACKOFF_MAX, self.quorum_time(self.peers(1), BACKOFF_MIN, BACKOFF_MIN) * 2 ** (lost - 1))
+        delay = random.uniform(0, cap)
+        self.metrics.observe("backoff", delay * 1000)
+        await asyncio.sleep(delay)
+
+    def learned_as(self, log_slot, proposed_value):
+        # Whether log_slot, which we already learned, holds proposed_value
+        if log_slot < self.decorated_site.log_base:
+            return False
+        return self.decorated_site.get_entry(log_slot).get("proposal_id") == proposed_value["proposal_id"]
+
+    async def prepare(self, log_slot, budget=None):
+        # Returns the promises and the budget left, or no promises if log_slot got chosen while we were retrying
+        budget = budget or RetryBudget()
+        self.tracer.debug("prepare", log_slot, self.decorated_site.max_prop_num[log_slot])
         obj = {
                 "event"      : PaxosEvent.PREPARE,
                 "propose_num": self.decorated_site.max_prop_num[log_slot],
                 "log_slot"   : log_slot
                 }
-        res, max_nack = self.send_to_majority(obj)
+        res, max_nack = await self.send_to_majority(obj)
 
         if len(res) < self.decorated_site.majority:
-            new_num = max(self.decorated_site.max_prop_num[log_slot], max_nack) + 1
-            logging.info(f"(retry) sending prepare({new_num}) to slot {log_slot}")
+            new_num = next_ballot(max(self.decorated_site.max_prop_num[log_slot], max_nack), self.decorated_site.site_id)
+            self.tracer.info("retry_prepare", log_slot, new_num, max_nack=max_nack, replies=len(res))
+            self.metrics.incr("retries")
             self.decorated_site.max_prop_num[log_slot] = new_num
-            return self.prepare(log_slot, try_num + 1)
-        return (res, try_num)
+            await self.retry(budget, max_nack)
+            if self.decorated_site.is_learned(log_slot):
+                # Whoever beat us is done with it, another round would only learn their value
+                return (None, budget)
+            return await self.prepare(log_slot, budget)
+        return (res, budget)
 
-    def accept(self, promised_sites, proposed_value, log_slot, try_num=0):
+    async def accept(self, promised_sites, proposed_value, log_slot, budget=None):
+        if promised_sites == None:
+            return self.learned_as(log_slot, proposed_value)
         assert len(promised_sites) >= self.decorated_site.majority
         original_prop_num = self.decorated_site.max_prop_num[log_slot]
 
@@ -121,22 +340,30 @@ class Proposer(AbstractSiteDecorator):
                 if r["event"] != PaxosEvent.PROMISE:
                     raise Exception("Something went wrong during second phase of proposal")
                 if r["accepted_num"] and (not largest_num or r["accepted_num"] > largest_num):
+                    largest_num = r["accepted_num"]
                     accepted_prop_val = r["accepted_val"]
 
         obj = {
-                "event"      : PaxosEvent.ACCEPT,
-                "propose_num": original_prop_num,
-                "propose_val": accepted_prop_val,
-                "log_slot"   : log_slot
+                "event"       : PaxosEvent.ACCEPT,
+                "propose_num" : original_prop_num,
+                "propose_val" : accepted_prop_val,
+                "log_slot"    : log_slot,
+                "origin"      : self.decorated_site.site_id,
+                "commit_index": self.decorated_site.cur_log_slot() # Everything below is chosen, acceptors' learners pull what they miss
                 }
-        logging.info(f"sending accept({original_prop_num}, {accepted_prop_val}) to slot {log_slot}")
-        res, max_nack = self.send_to_majority(obj)
+        self.tracer.debug("accept", log_slot, original_prop_num, val=accepted_prop_val)
+        res, max_nack = await self.send_to_majority(obj)
         if len(res) < self.decorated_site.majority:
-            new_num = max(self.decorated_site.max_prop_num[log_slot] + 1, max_nack)
+            new_num = next_ballot(max(self.decorated_site.max_prop_num[log_slot], max_nack), self.decorated_site.site_id)
+            self.tracer.info("retry_accept", log_slot, new_num, max_nack=max_nack, replies=len(res))
+            self.metrics.incr("retries")
             self.decorated_site.max_prop_num[log_slot] = new_num
-            logging.info(f"Proposer: Proposal# {self.decorated_site.max_prop_num[log_slot]} too small, retrying with {new_num}")
-            res, num_tries = self.prepare(try_num + 1)
-            self.accept(res, proposed_value, log_slot, try_num=num_tries)
+            budget = budget or RetryBudget()
+            await self.retry(budget, max_nack)
+            if self.decorated_site.is_learned(log_slot):
+                return self.learned_as(log_slot, proposed_value)
+            res, budget = await self.prepare(log_slot, budget)
+            return await self.accept(res, proposed_value, log_slot, budget)
         else:
             # Proposer acts as distinguished learner
             counter = defaultdict(int)
@@ -151,136 +378,489 @@ class Proposer(AbstractSiteDecorator):
                     max_count = counter[r["accepted_num"]]
             if max_count >= self.decorated_site.majority:
                 self.commit(commit_val, log_slot)
+                # Our own learner may not have this slot yet, don't propose into it again
+                self.next_slot = max(self.next_slot, log_slot + 1)
                 return commit_val["proposal_id"] == proposed_value["proposal_id"] # If learned entry is the same as proposed, then we know proposal has gone through
         return False
 
-    def fill_hole(self):
-        for hole in list(self.decorated_site.holes)[:-1]:
-            try:
-                res, _ = self.prepare(hole)
-                commit_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                addr = ("127.0.0.1", self.decorated_site.site_dict[self.decorated_site.site_id]["udp_start_port"] + 2) # +2 cuz it's the learners
-                commit_val = max(res, key=lambda x:x["accepted_num"] if x["accepted_num"] else -1)["accepted_val"]
-                if commit_val:
-                    obj = {
-                        "event"     : PaxosEvent.COMMIT,
-                        "commit_val": commit_val,
-                        "log_slot"  : hole
+    async def become_leader(self, budget=None, silent=None):
+        # Multi-Paxos phase 1: a single prepare for every slot from the first hole onward.
+        # Returns False, without retrying, if acceptors are under the lease of a leader other than the silent one.
+        budget = budget or RetryBudget()
+        self.leader_hint = None
+        from_slot = self.decorated_site.cur_log_slot()
+        start = self.runtime.now()
+        self.tracer.debug("prepare_all", from_slot, self.leader_prop_num)
+        obj = {
+                "event"      : PaxosEvent.PREPARE,
+                "propose_num": self.leader_prop_num,
+                "log_slot"   : from_slot,
+                "all_slots"  : True,
+                "origin"     : self.decorated_site.site_id
+                }
+        # Any slot a majority may have chosen shows up in at least one promise
+        recovered = {}
+        while True:
+            res, max_nack = await self.send_to_majority(obj)
+            if len(res) < self.decorated_site.majority:
+                self.leader_prop_num = next_ballot(max(self.leader_prop_num, max_nack), self.decorated_site.site_id)
+                if self.leader_hint not in (None, silent):
+                    # That leader is alive and can take our proposals
+                    self.tracer.info("leader_busy", from_slot, self.leader_prop_num, leader=self.leader_hint)
+                    return False
+                self.tracer.info("retry_prepare_all", from_slot, self.leader_prop_num, max_nack=max_nack, replies=len(res))
+                self.metrics.incr("retries")
+                await self.retry(budget, max_nack)
+                return await self.become_leader(budget, silent)
+            for r in res:
+                for slot, num, val in r["accepted"]:
+                    if slot not in recovered or num > recovered[slot][0]:
+                        recovered[slot] = (num, val)
+            # Every reply covers the slots below where the shortest one stopped, ask for the rest under the same ballot
+            more = [r["accepted"][-1][0] + 1 for r in res if r.get("more")]
+            if not more:
+                break
+            obj = dict(obj, log_slot=min(more))
+        self.is_leader = True
+        self.extend_lease(start)
+        self.next_slot = max([from_slot] + [slot + 1 for slot in recovered])
+        for slot in range(from_slot, self.next_slot):
+            if self.decorated_site.is_learned(slot):
+                continue
+            if slot in recovered:
+                value = recovered[slot][1]
+            else:
+                # Nothing was accepted here. A NOOP under our ballot closes the hole, so later slots don't wait on a classic prepare.
+                value = {"action": UserAction.NOOP}
+                self.assign_proposal_id(value)
+            if not await self.send_accept(value, slot):
+                raise Exception(f"Lost leadership while recovering slot {slot}")
+        self.tracer.info("leader", from_slot, self.leader_prop_num, recovered=len(recovered))
+        return True
+
+    async def send_accept(self, proposed_value, log_slot):
+        # Multi-Paxos phase 2 only, under the leader's proposal number
+        obj = {
+                "event"       : PaxosEvent.ACCEPT,
+                "propose_num" : self.leader_prop_num,
+                "propose_val" : proposed_value,
+                "log_slot"    : log_slot,
+                "origin"      : self.decorated_site.site_id,
+                "commit_index": self.decorated_site.cur_log_slot()
+                }
+        start = self.runtime.now()
+        self.tracer.debug("accept", log_slot, self.leader_prop_num, val=proposed_value)
+        res, max_nack = await self.send_to_majority(obj)
+        if len(res) < self.decorated_site.majority:
+            # Someone else got a higher promise, step down
+            self.is_leader = False
+            self.leader_prop_num = next_ballot(max(self.leader_prop_num, max_nack), self.decorated_site.site_id)
+            self.tracer.info("preempted", log_slot, self.leader_prop_num, max_nack=max_nack, replies=len(res))
+            self.metrics.incr("retries")
+            return False
+        if len([r for r in res if r.get("lease")]) >= self.decorated_site.majority:
+            # Acceptors that missed our prepare_all accept without granting a lease
+            self.extend_lease(start)
+        self.commit(proposed_value, log_slot)
+        return True
+
+    def extend_lease(self, start):
+        # start is when the round that a majority granted was sent
+        if self.lease_time:
+            self.lease_until = max(self.lease_until, start + self.lease_time * 0.9)
+
+    def has_lease(self):
+        return self.is_leader and self.runtime.now() < self.lease_until
+
+    async def renew_lease(self):
+        # Keeps an idle leader's lease alive. Writes renew it too, so this only sends when nothing else did.
+        while True:
+            await asyncio.sleep(self.lease_time / 3)
+            if not self.is_leader or self.lease_until - self.runtime.now() > self.lease_time * 0.5:
+                continue
+            obj = {
+                    "event"       : PaxosEvent.LEASE,
+                    "propose_num" : self.leader_prop_num,
+                    "origin"      : self.decorated_site.site_id,
+                    "commit_index": self.decorated_site.cur_log_slot() # Idle followers find a lost last COMMIT from this
+                    }
+            start = self.runtime.now()
+            res, max_nack = await self.send_to_majority(obj)
+            if len(res) >= self.decorated_site.majority:
+                self.extend_lease(start)
+            elif max_nack > self.leader_prop_num:
+                self.is_leader = False
+                self.tracer.info("lease_refused", num=self.leader_prop_num, max_nack=max_nack)
+
+    async def read_index(self):
+        # Brings local state up to every write committed before this call, so what we read or validate is linearizable.
+        # A leaseholder already has it. Everyone else asks the leader, or a majority when there is no leader to ask.
+        site = self.decorated_site
+        if self.has_lease():
+            self.metrics.incr("reads.lease")
+            index = max(self.commit_index, site.cur_log_slot())
+        else:
+            index = None
+            leader = site.acceptor_state.leader_id
+            if self.lease_time and leader != None and leader != site.site_id:
+                obj = {
+                        "event": PaxosEvent.READ_INDEX
+                        }
+                res = await self.runtime.request(obj, [self.address(leader, 0)], 1, 0.5)
+                if res and res[0]["event"] == PaxosEvent.ACK:
+                    self.metrics.incr("reads.leader")
+                    index = res[0]["index"]
+            if index == None:
+                self.metrics.incr("reads.quorum")
+                obj = {
+                        "event": PaxosEvent.SEEK
                         }
-                    commit_socket.sendto(json.dumps(obj).encode("utf-8"), addr)
+                res, _ = await self.send_to_majority(obj, port_offset=2)
+                index = max([r["cur_slot"] for r in res] + [site.cur_log_slot()])
+        await self.wait_applied(index)
+
+    async def wait_applied(self, index, timeout=0.2):
+        # Commits for slots below index are normally already on their way here. Whatever is still missing after timeout gets filled.
+        site = self.decorated_site
+        site.gaps.extend_to(index)
+        try:
+            await asyncio.wait_for(site.applied_event(index).wait(), timeout)
+        except asyncio.TimeoutError:
+            peers = sorted(site.site_dict, key=lambda k: k != site.acceptor_state.leader_id)
+            await self.catch_up(peers)
+            await self.fill_hole()
+        if site.applied_slot + 1 < index:
+            self.tracer.info("behind", index, applied_slot=site.applied_slot)
+
+    async def read(self, fn, *args):
+        await self.read_index()
+        return fn(*args)
+
+    async def forward(self, proposed_value, leader):
+        # Returns the leader's reply, None once it has been silent for long enough to take over
+        addr = self.address(leader, 0)
+        obj = {
+                "event"      : PaxosEvent.FORWARD,
+                "propose_val": proposed_value
+                }
+        self.tracer.debug("forward", leader=leader, val=proposed_value)
+        started = self.runtime.now()
+        timeout = min(self.response_times.timeout([addr], 1, QUORUM_TIMEOUT_MIN, QUORUM_TIMEOUT), QUORUM_TIMEOUT)
+        attempt = 0
+        while True:
+            res = await self.runtime.request(obj, [addr], 1, timeout, times=self.response_times)
+            if res:
+                return res[0]
+            attempt += 1
+            if attempt >= FORWARD_RETRIES and self.runtime.now() - started >= self.lease_time:
+                self.tracer.info("forward_timeout", leader=leader)
+                return None
+            # Lost on the way or the leader is still at it. Either way the resend joins the same proposal.
+            self.metrics.incr("forward.retries")
+            timeout = min(timeout * 2, QUORUM_TIMEOUT)
+
+    async def propose_multi(self, proposed_value, forwarded=False, max_try=3):
+        # Returns the slot proposed_value was committed in, None if the leader we forwarded to gave up.
+        # A forwarded value is handed back unproposed, also None, if another site holds the lease.
+        silent = None
+        sent = False
+        for _ in range(max_try):
+            leader = self.leader_hint if self.leader_hint != None else self.decorated_site.acceptor_state.leader_id
+            if not forwarded and not self.is_leader and leader not in (None, silent, self.decorated_site.site_id):
+                res = await self.forward(proposed_value, leader)
+                if res != None and (res["committed"] or res.get("lease_holder") == None):
+                    return res.get("log_slot") if res["committed"] else None
+                # Leader has been silent for a whole lease, take over. Or it never proposed the value, take it to the lease holder.
+                silent = leader
+                self.leader_hint = res["lease_holder"] if res != None else None
+            async with self.leader_lock:
+                if not self.is_leader and not await self.become_leader(silent=silent):
+                    if forwarded and not sent:
+                        return None
+                    # Another leader holds the lease, forward to it on the next try
+                    continue
+                slot = self.reserve_slot()
+            sent = True
+            try:
+                if await self.send_accept(proposed_value, slot):
+                    return slot
+            finally:
+                self.inflight.discard(slot)
+        raise Exception("Max number of tries exceeded")
+
+    def reserve_slot(self):
+        # Hands out a different slot to every proposal in flight. Slots learned past the first hole are already taken.
+        slot = max(self.decorated_site.cur_log_slot(), self.next_slot)
+        while self.decorated_site.is_learned(slot):
+            slot += 1
+        self.next_slot = slot + 1
+        self.inflight.add(slot)
+        return slot
+
+    def release_slot(self, slot):
+        # Proposal in slot failed outright. Hand it out again if nothing was reserved after it.
+        self.inflight.discard(slot)
+        if self.next_slot == slot + 1:
+            self.next_slot = slot
+
+    async def fill_hole(self):
+        gaps = self.decorated_site.gaps
+        for hole in list(gaps):
+            if not gaps.is_missing(hole):
+                # Learned while we were busy with an earlier hole
+                continue
+            if hole in self.inflight:
+                # One of our own pipelined proposals
+                continue
+            start = time.perf_counter()
+            try:
+                res, _ = await self.prepare(hole)
+                if res == None:
+                    continue
+                # An accepted value isn't necessarily chosen, so it goes through phase 2 like any other.
+                # accept() re-proposes the highest accepted value, the NOOP only closes a hole nothing was accepted in.
+                noop = {"action": UserAction.NOOP}
+                self.assign_proposal_id(noop)
+                await self.accept(res, noop, hole)
             except Exception as e:
-                logging.info(f"Proposal failed for slot {hole}")
+                self.tracer.info("fill_failed", hole, error=str(e))
+            self.metrics.since("fill_hole", start)
              
 
-    def propose(self, proposed_value):
-        proposed_value["proposal_id"] = f"{self.decorated_site.site_name}_{self.decorated_site.proposal_counter}"
-        self.decorated_site.proposal_counter = self.decorated_site.proposal_counter + 1
-        try:
-            res, num_tries = self.prepare(self.decorated_site.cur_log_slot())
-            committed = self.accept(res, proposed_value, self.decorated_site.cur_log_slot(), try_num=num_tries)
-            if not committed:
-                raise Exception("Proposal failed.")
-            return True
-        except Exception as e:
-            logging.info(e)
-            return False
+    def assign_proposal_id(self, proposed_value):
+        proposed_value["proposal_id"] = f"{self.decorated_site.site_name}_{self.decorated_site.counters.take('proposal')}"
+
+    async def propose(self, proposed_value):
+        # PendingAction once it is done, its slot tells where the action went
+        pending = await self.submit(proposed_value)
+        await pending.wait()
+        return pending
 
-    def create_project(self, project_name, funding_goal):
-        self.fill_hole()
-        if project_name in self. decorated_site.crowdfund:
-            print(f"Unable to create {project_name}, already exists.")
+    async def submit(self, proposed_value):
+        # Returns a PendingAction. Without batching or pipelining it is already resolved.
+        self.assign_proposal_id(proposed_value)
+        pending = PendingAction(proposed_value, self.metrics)
+        if self.decorated_site.config["batch_size"] > 1:
+            self.decorated_site.waiters[proposed_value["proposal_id"]] = pending
+            self.batch_queue.put_nowait(pending)
+        elif self.decorated_site.config["pipeline_window"] > 1:
+            self.decorated_site.waiters[proposed_value["proposal_id"]] = pending
+            await self.window.acquire()
+            asyncio.ensure_future(self.propose_pending([pending]))
         else:
-            self.fill_hole()
-            proposed_value = {
-                    "action"      : UserAction.CREATE_PROJECT,
-                    "project_name": project_name,
-                    "funding_goal": funding_goal
-                    }
-            if self.propose(proposed_value):
-                print(f"Created project {project_name}.")
-            else:
-                print(f"Unable to create {project_name}.")
-
-    def cancel_project(self, project_name):
-        print(self.decorated_site.pledges.get(project_name))
-        print(self.decorated_site.crowdfund.get(project_name))
-        self.fill_hole()
-        if self.decorated_site.pledges.get(project_name) == None:
-            print(f"Can't find project {project_name}")
-        elif len(self.decorated_site.pledges.get(project_name))*100 < self.decorated_site.crowdfund.get(project_name):
-            proposed_value = {
-                    "action"      : UserAction.CANCEL_PROJECT,
-                    "project_name": project_name
-                    }   
-            pledges = list(self.decorated_site.pledges[proposed_value["project_name"]])
-            withdraw_failed = False
-            for pledge in pledges:
-                withdraw_proposed_value = {
-                        "action"      : UserAction.WITHDRAW_PLEDGE,
-                        "pledge_id"   : pledge[0],
-                        "project_name": project_name
-                        }
-                if not self.propose(withdraw_proposed_value):
-                    withdraw_failed = True
-            if withdraw_failed:
-                print("Some pledges withdrawn, but unable to cancel " + proposed_value["project_name"] + ".")
-            elif self.propose(proposed_value):
-                print("Project " + proposed_value["project_name"] + " cancelled.")
+            slot = await self.propose_value(proposed_value)
+            pending.resolve(slot != None, slot=slot)
+        return pending
+
+    async def propose_pending(self, batch):
+        # Runs as its own task, holding one place in the pipeline window
+        try:
+            if len(batch) == 1 and self.decorated_site.config["batch_size"] == 1:
+                proposed_value = batch[0].value
             else:
-                print(f"Unable to cancel {project_name}.")
-        else:
-            print(f"Unable to cancel {project_name}.")
-            
-
-    def create_pledge(self, project_name, user_id):
-        self.fill_hole()
-        pledge_id = f"{user_id}{self.decorated_site.pledge_counter}"
-        if project_name not in self.decorated_site.crowdfund:
-            print(f"Project {project_name} not found!")
-        else:
-            if len(self.decorated_site.pledges.get(project_name))*100 < self.decorated_site.crowdfund.get(project_name):
                 proposed_value = {
-                        "action"      : UserAction.CREATE_PLEDGE,
-                        "project_name": project_name,
-                        "pledge_id"   : pledge_id,
-                        "site_name"   : self.decorated_site.site_name,
+                        "action" : UserAction.BATCH,
+                        "actions": [pending.value for pending in batch]
                         }
-                if self.propose(proposed_value):
-                    print(f"Created pledge {pledge_id} to {project_name}.")
-                    self.decorated_site.pledge_counter += 1
+                self.assign_proposal_id(proposed_value)
+                self.tracer.debug("batch", proposal_id=proposed_value["proposal_id"], actions=len(batch))
+            slot = await self.propose_value(proposed_value)
+            for pending in batch:
+                if slot != None:
+                    # Learner reports whether each action was applied
+                    pending.committed = True
+                    pending.slot = slot
                 else:
-                    print(f"Cannot create pledge to {project_name}.")
+                    self.decorated_site.waiters.pop(pending.value["proposal_id"], None)
+                    pending.resolve(False)
+        finally:
+            self.window.release()
+
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        batch_size = self.decorated_site.config["batch_size"]
+        linger = self.decorated_site.config["batch_linger_ms"] / 1000
+        while True:
+            batch = [await self.batch_queue.get()]
+            deadline = loop.time() + linger
+            while len(batch) < batch_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.batch_queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self.window.acquire()
+            asyncio.ensure_future(self.propose_pending(batch))
+
+    async def propose_value(self, proposed_value, max_try=3):
+        # Returns the slot proposed_value was committed in, None if it failed
+        start = time.perf_counter()
+        try:
+            committed = False
+            if self.decorated_site.config["leader_mode"]:
+                log_slot = await self.propose_multi(proposed_value)
+                committed = log_slot != None
             else:
-                print(f"Cannot create pledge to {project_name}.")
-
-    def withdraw_pledge(self, pledge_id):
-        self.fill_hole()
-        for key,value in self.decorated_site.pledges.items():
-            for v in value:
-                if pledge_id == v[0]:
-                    proposed_value = {
-                            "action"      : UserAction.WITHDRAW_PLEDGE,
-                            "pledge_id"   : pledge_id,
-                            "project_name": key
-                            }
-                    if len(value)*100 < self.decorated_site.crowdfund[key]:
-                        if self.propose(proposed_value):
-                            print(f"Withdrew pledge {pledge_id}.")
-                            return
-                        else:
-                            print(f"Cannot withdraw {pledge_id}.")
-                            return
-        print(f"Pledge {pledge_id} not found")
-
-class Counter():
-    def __init__(self, target):
-        self.count = 0
-        self.lock = threading.Lock()
-        self.target = target
-
-    def increse(self):
-        with self.lock:
-            self.count += 1
-
-    def reached_target(self):
-        return self.count >= self.target
+                budget = RetryBudget()
+                while not committed:
+                    log_slot = self.reserve_slot()
+                    try:
+                        res, budget = await self.prepare(log_slot, budget)
+                        committed = await self.accept(res, proposed_value, log_slot, budget)
+                    except Exception:
+                        self.release_slot(log_slot)
+                        raise
+                    self.inflight.discard(log_slot)
+                    if not committed:
+                        # Slot went to another value, move on to the next one straight away.
+                        # Someone made progress, so no backoff, but it still counts against the budget.
+                        budget.lose(True)
+                        self.metrics.incr("retries")
+            if not committed:
+                raise Exception("Proposal failed.")
+            self.metrics.since("commit", start)
+            return log_slot
+        except Exception as e:
+            self.tracer.info("proposal_failed", proposal_id=proposed_value.get("proposal_id"), error=str(e))
+            self.metrics.incr("failed_proposals")
+            return None
+
+    async def create_project(self, project_name, funding_goal):
+        await self.read_index()
+        if self.decorated_site.state.has_project(project_name):
+            return Outcome(False, [f"Unable to create {project_name}, already exists."])
+        proposed_value = {
+                "action"      : UserAction.CREATE_PROJECT,
+                "project_name": project_name,
+                "funding_goal": funding_goal
+                }
+        pending = await self.propose(proposed_value)
+        if pending.result:
+            return Outcome(True, [f"Created project {project_name}."], pending.slot)
+        return Outcome(False, [f"Unable to create {project_name}."], pending.slot)
+
+    async def cancel_project(self, project_name):
+        state = self.decorated_site.state
+        lines = [str(state.list_pledges(project_name)), str(state.funding_goal(project_name))]
+        await self.read_index()
+        if not state.has_project(project_name):
+            return Outcome(False, lines + [f"Can't find project {project_name}"])
+        if not state.is_open(project_name):
+            return Outcome(False, lines + [f"Unable to cancel {project_name}."])
+        proposed_value = {
+                "action"      : UserAction.CANCEL_PROJECT,
+                "project_name": project_name
+                }   
+        pledges = state.list_pledges(project_name)
+        withdrawals = []
+        for pledge in pledges:
+            withdraw_proposed_value = {
+                    "action"      : UserAction.WITHDRAW_PLEDGE,
+                    "pledge_id"   : pledge[0],
+                    "project_name": project_name
+                    }
+            # Submit them all first so they can share a batch
+            withdrawals.append(await self.submit(withdraw_proposed_value))
+        withdraw_failed = not all([await pending.wait() for pending in withdrawals])
+        if withdraw_failed:
+            return Outcome(False, lines + ["Some pledges withdrawn, but unable to cancel " + proposed_value["project_name"] + "."])
+        pending = await self.propose(proposed_value)
+        if pending.result:
+            return Outcome(True, lines + ["Project " + proposed_value["project_name"] + " cancelled."], pending.slot)
+        return Outcome(False, lines + [f"Unable to cancel {project_name}."], pending.slot)
+
+    async def create_pledge(self, project_name, user_id):
+        await self.read_index()
+        state = self.decorated_site.state
+        if not state.has_project(project_name):
+            return Outcome(False, [f"Project {project_name} not found!"])
+        if not state.is_open(project_name):
+            return Outcome(False, [f"Cannot create pledge to {project_name}."])
+        # Taken before proposing, so pledges in flight at the same time never share an id. A failed one leaves a gap.
+        pledge_id = f"{user_id}{self.decorated_site.counters.take('pledge')}"
+        proposed_value = {
+                "action"      : UserAction.CREATE_PLEDGE,
+                "project_name": project_name,
+                "pledge_id"   : pledge_id,
+                "site_name"   : self.decorated_site.site_name,
+                }
+        pending = await self.propose(proposed_value)
+        if pending.result:
+            return Outcome(True, [f"Created pledge {pledge_id} to {project_name}."], pending.slot)
+        return Outcome(False, [f"Cannot create pledge to {project_name}."], pending.slot)
+
+    async def withdraw_pledge(self, pledge_id):
+        await self.read_index()
+        state = self.decorated_site.state
+        project_name = state.project_of(pledge_id)
+        if project_name == None or not state.is_open(project_name):
+            return Outcome(False, [f"Pledge {pledge_id} not found"])
+        proposed_value = {
+                "action"      : UserAction.WITHDRAW_PLEDGE,
+                "pledge_id"   : pledge_id,
+                "project_name": project_name
+                }
+        pending = await self.propose(proposed_value)
+        if pending.result:
+            return Outcome(True, [f"Withdrew pledge {pledge_id}."], pending.slot)
+        return Outcome(False, [f"Cannot withdraw {pledge_id}."], pending.slot)
+
+class RetryBudget():
+    # Rounds one proposal may lose. NACKs mean another proposer is working on the slot, that is worth backing off and trying again.
+    # Rounds nobody answered usually mean peers are down, and more of them won't help.
+    def __init__(self):
+        self.nacks = 0
+        self.timeouts = 0
+
+    def lose(self, nacked):
+        # Returns how many rounds are lost so far, raises once the budget is spent
+        if nacked:
+            self.nacks += 1
+        else:
+            self.timeouts += 1
+        if self.nacks >= NACK_BUDGET or self.timeouts >= TIMEOUT_BUDGET:
+            raise Exception("Max number of tries exceeded")
+        return self.nacks + self.timeouts
+
+class Outcome():
+    # What a user command did: whether it went through, the lines to show the user and the slot it was committed in.
+    # Plain attributes only, outcomes cross the pipe from worker processes.
+    def __init__(self, ok, lines, slot=None):
+        self.ok = ok
+        self.lines = lines
+        self.slot = slot
+
+class PendingAction():
+    def __init__(self, value, metrics):
+        self.value = value
+        self.metrics = metrics
+        self.committed = None # Set once the slot holding the action is chosen
+        self.applied = None   # Set by the local learner once the action is applied
+        self.slot = None      # Slot the action was committed in, when we know it
+        self.result = None
+        self.done = asyncio.Event()
+        self.submitted = time.perf_counter()
+
+    def resolve(self, committed, applied=None, slot=None):
+        self.committed = committed
+        self.applied = applied
+        if slot != None:
+            self.slot = slot
+        self.done.set()
+
+    async def wait(self):
+        # If the local learner missed the COMMIT, a chosen slot is good enough
+        while True:
+            try:
+                await asyncio.wait_for(self.done.wait(), 1)
+                break
+            except asyncio.TimeoutError:
+                if self.committed != None:
+                    break
+        self.result = self.applied if self.applied != None else bool(self.committed)
+        # bench.py reads these from the stats
+        self.metrics.since("action", self.submitted)
+        self.metrics.incr("actions.committed" if self.result else "actions.failed")
+        return self.result
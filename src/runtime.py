@@ -0,0 +1,276 @@
+import logging
+import asyncio
+import itertools
+import json
+import threading
+from codec import ENCODERS, decode
+
+class RoleProtocol(asyncio.DatagramProtocol):
+    # Server side of a role. Handlers return a reply, a coroutine producing one, or None.
+    def __init__(self, name, handler, runtime):
+        self.name = name
+        self.handler = handler
+        self.runtime = runtime
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.runtime.metrics.incr("received")
+        try:
+            decoded_message = decode(data)
+            # The reply carries the request id back, so it reaches the round that asked
+            request_id = decoded_message.pop("request_id", None)
+            res = self.handler(decoded_message)
+        except Exception as e:
+            logging.info(f"{self.name}: Error while receiving: {e}")
+            return
+        if asyncio.iscoroutine(res):
+            asyncio.ensure_future(self.reply_later(res, request_id, addr))
+        elif res != None:
+            self.reply(res, request_id, addr)
+
+    def reply(self, res, request_id, addr):
+        if request_id != None:
+            res = dict(res, request_id=request_id)
+        self.runtime.metrics.incr("sent")
+        self.transport.sendto(self.runtime.encode(res), addr)
+
+    async def reply_later(self, coro, request_id, addr):
+        try:
+            res = await coro
+        except Exception as e:
+            logging.info(f"{self.name}: Error while handling: {e}")
+            return
+        if res != None:
+            self.reply(res, request_id, addr)
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    # The runtime's one outgoing socket. Every request goes out through it and replies are routed back by request id.
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def datagram_received(self, data, addr):
+        self.runtime.metrics.incr("received")
+        try:
+            reply = decode(data)
+        except Exception:
+            return
+        pending = self.runtime.pending.get(reply.pop("request_id", None))
+        if pending == None:
+            # Answer to a round that is already over, or to a fire and forget message
+            self.runtime.metrics.incr("stale_replies")
+            return
+        pending.received(reply, addr)
+
+    def error_received(self, exc):
+        # Port unreachable from a site that is down
+        pass
+
+class Round():
+    # Client side of one request. done fires once target replies are in.
+    def __init__(self, target, times=None):
+        self.target = target
+        self.times = times
+        self.loop = asyncio.get_running_loop()
+        self.start = self.loop.time()
+        self.replies = []
+        self.answered = set()
+        self.done = self.loop.create_future()
+
+    def received(self, reply, addr):
+        if addr in self.answered:
+            # Duplicate
+            return
+        self.answered.add(addr)
+        if self.times != None:
+            self.times.observe(addr, self.loop.time() - self.start)
+        self.add(reply)
+
+    def add(self, reply):
+        self.replies.append(reply)
+        if len(self.replies) >= self.target and not self.done.done():
+            self.done.set_result(None)
+
+class StatsProtocol(asyncio.DatagramProtocol):
+    # Scrape endpoint. Any datagram gets the site's metrics back as JSON, whatever the wire codec.
+    def __init__(self, dump):
+        self.dump = dump
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        self.transport.sendto(json.dumps(self.dump()).encode("utf-8"), addr)
+
+class ResponseTimes():
+    # Smoothed time each peer address takes to answer a round, and how much it varies. Same estimator as TCP's.
+    def __init__(self):
+        self.times = {}
+        self.deviations = {}
+
+    def observe(self, addr, seconds):
+        old = self.times.get(addr)
+        if old == None:
+            self.times[addr] = seconds
+            self.deviations[addr] = seconds / 2
+            return
+        self.times[addr] = old + (seconds - old) / 8
+        self.deviations[addr] += (abs(seconds - old) - self.deviations[addr]) / 4
+
+    def missed(self, addr, seconds):
+        # No answer within seconds, so it takes at least that long
+        self.times[addr] = max(self.times.get(addr, 0), seconds)
+        self.deviations.setdefault(addr, seconds / 2)
+
+    def fastest(self, addrs, count):
+        # Peers nobody has timed yet go first, so they get a sample
+        return sorted(addrs, key=lambda addr: self.times.get(addr, 0))[:count]
+
+    def overdue(self, addr):
+        # An answer from addr that hasn't come by now is most likely lost
+        return self.times[addr] + 4 * self.deviations[addr]
+
+    def timeout(self, addrs, count, floor, default):
+        # When the count fastest of addrs are all overdue, never below floor. default until enough of them have been timed.
+        if count <= 0:
+            return floor
+        overdue = sorted(self.overdue(addr) for addr in addrs if addr in self.times)
+        if len(overdue) < count:
+            return default
+        return max(overdue[count - 1], floor)
+
+class Runtime():
+    # One event loop per site. Every role's socket lives on it, so Site state is only touched from its thread.
+    def __init__(self, metrics, wire_codec="binary", loop=None):
+        self.metrics = metrics
+        self.encode = ENCODERS[wire_codec]
+        self.loop = loop or asyncio.new_event_loop()
+        self.transport = None
+        self.request_ids = itertools.count(1)
+        self.pending = {} # key: request id. value: Round waiting for the replies
+        self.handlers = {} # key: port. value: handler of the role served on it, for in-process delivery
+
+    def start(self):
+        loop_thread = threading.Thread(target=self.loop.run_forever)
+        loop_thread.daemon = True
+        loop_thread.start()
+        self.transport = self.run(self.open_endpoint(lambda: ClientProtocol(self)))[0]
+
+    def now(self):
+        # Clock for timeouts and leases. It is the loop's, so a simulated loop runs them on virtual time.
+        return self.loop.time()
+
+    def run(self, coro):
+        # Called from other threads, blocks until the coroutine is done on the loop
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def invoke(self, fn, *args):
+        # Runs fn on the loop and blocks for its result, whether it is a coroutine function or not
+        return self.invoke_async(fn, *args).result()
+
+    def invoke_async(self, fn, *args):
+        # Same as invoke, but returns a concurrent.futures.Future right away
+        if asyncio.iscoroutinefunction(fn):
+            return asyncio.run_coroutine_threadsafe(fn(*args), self.loop)
+        async def wrapper():
+            return fn(*args)
+        return asyncio.run_coroutine_threadsafe(wrapper(), self.loop)
+
+    async def open_endpoint(self, protocol_factory, port=0):
+        return await self.loop.create_datagram_endpoint(protocol_factory, local_addr=("0.0.0.0", port))
+
+    def serve(self, name, port, handler):
+        self.run(self.open_endpoint(lambda: RoleProtocol(name, handler, self), port))
+        self.handlers[port] = (name, handler)
+        logging.info(f"{name}: Now listening on port {port}.")
+
+    def deliver(self, obj, port):
+        # Hands obj straight to the role served on port in this process, skipping the codec and the network stack.
+        # Returns what the handler does: a reply, a coroutine producing one, or None.
+        name, handler = self.handlers[port]
+        self.metrics.incr("local")
+        try:
+            # Handlers own the message they get, same as a decoded one
+            return handler(dict(obj))
+        except Exception as e:
+            logging.info(f"{name}: Error while receiving: {e}")
+            return None
+
+    def send_local(self, obj, port):
+        # Fire and forget to a role in this process
+        res = self.deliver(obj, port)
+        if asyncio.iscoroutine(res):
+            asyncio.ensure_future(res)
+
+    async def deliver_reply(self, obj, port, pending):
+        res = self.deliver(obj, port)
+        if asyncio.iscoroutine(res):
+            try:
+                res = await res
+            except Exception as e:
+                logging.info(f"{self.handlers[port][0]}: Error while handling: {e}")
+                return
+        if res != None:
+            pending.add(res)
+
+    def serve_stats(self, port, dump=None):
+        # dump returns the metrics to serve, our own by default
+        self.run(self.open_endpoint(lambda: StatsProtocol(dump or self.metrics.dump), port))
+        logging.info(f"Stats: Now listening on port {port}.")
+
+    def send(self, obj, addr):
+        # Fire and forget, must be called on the loop
+        self.metrics.incr("sent")
+        self.transport.sendto(self.encode(obj), addr)
+
+    async def request(self, obj, addrs, target, timeout, local=(), widen=None, times=None):
+        # Sends obj to every address, returns whatever replies arrived once target is reached or time is up.
+        # local are ports of roles in this process, they get obj in-process.
+        # widen is (more addresses, seconds): if target isn't reached by then, obj goes to those too.
+        # times, a ResponseTimes, learns how long each address took.
+        request_id = next(self.request_ids)
+        pending = Round(target, times)
+        self.pending[request_id] = pending
+        try:
+            message = self.encode(dict(obj, request_id=request_id))
+            for addr in addrs:
+                self.transport.sendto(message, addr)
+            self.metrics.incr("sent", len(addrs))
+            for port in local:
+                asyncio.ensure_future(self.deliver_reply(obj, port, pending))
+            sent = list(addrs)
+            if widen:
+                more, after = widen
+                try:
+                    await asyncio.wait_for(asyncio.shield(pending.done), min(after, timeout))
+                except asyncio.TimeoutError:
+                    self.metrics.incr("widened")
+                    for addr in more:
+                        self.transport.sendto(message, addr)
+                    self.metrics.incr("sent", len(more))
+                    sent += more
+            try:
+                await asyncio.wait_for(pending.done, pending.start + timeout - self.loop.time())
+            except asyncio.TimeoutError:
+                pass
+            if times != None:
+                elapsed = self.loop.time() - pending.start
+                for addr in sent:
+                    if addr not in pending.answered:
+                        times.missed(addr, elapsed)
+            return pending.replies
+        finally:
+            # Whatever still arrives for this round is stale and gets dropped
+            del self.pending[request_id]
+
+    def durable(self, wal, lsn):
+        # Future that resolves once the WAL has fsynced record lsn
+        future = self.loop.create_future()
+        def resolve():
+            if not future.done():
+                future.set_result(None)
+        wal.when_durable(lsn, lambda: self.loop.call_soon_threadsafe(resolve))
+        return future
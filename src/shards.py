@@ -0,0 +1,142 @@
+import asyncio
+import zlib
+from paxos_site import Site
+from acceptor import Acceptor
+from learner import Learner
+from proposer import Proposer, Outcome
+
+def group_of(project_name, groups):
+    # crc32 rather than hash(), which is salted differently in every process
+    return zlib.crc32(project_name.encode("utf-8")) % groups
+
+def project_lines(rows, count=None):
+    # Every group sends up to count rows, the first count of all of them make the page
+    return [f"{project} {funding_goal} {status}" for project, funding_goal, status in sorted(rows)[:count]]
+
+class Shards():
+    # The site's Paxos groups running in this process. Each has its own log, acceptor state, WAL and ports.
+    # Everything about a project goes through the group its name hashes to, so projects in different groups commit in parallel.
+    def __init__(self, site, runtime, groups=None):
+        # site runs the first of groups, all of the site's groups by default
+        self.runtime = runtime
+        self.total = site.config["groups"]
+        groups = groups or range(self.total)
+        self.sites = {site.group: site}
+        for group in groups:
+            if group != site.group:
+                self.sites[group] = Site(group, site.counters, site.metrics, site.knownhosts, site.storage)
+        self.metrics = site.metrics
+        self.proposers = {}
+        for group, group_site in self.sites.items():
+            learner = Learner(group_site, runtime)
+            learner.listen()
+            Acceptor(group_site, runtime, learner).listen()
+            self.proposers[group] = Proposer(group_site, runtime)
+            self.proposers[group].listen()
+
+    async def start(self):
+        await asyncio.gather(*[proposer.start() for proposer in self.proposers.values()])
+
+    def proposer(self, project_name):
+        return self.proposers[group_of(project_name, self.total)]
+
+    def group_of_pledge(self, pledge_id):
+        for group, site in self.sites.items():
+            if site.state.project_of(pledge_id) != None:
+                return group
+        return None
+
+    async def read_index(self):
+        await asyncio.gather(*[proposer.read_index() for proposer in self.proposers.values()])
+
+    # User commands return an Outcome
+    async def create_project(self, project_name, funding_goal):
+        return await self.proposer(project_name).create_project(project_name, funding_goal)
+
+    async def create_pledge(self, project_name, user_id):
+        return await self.proposer(project_name).create_pledge(project_name, user_id)
+
+    async def cancel_project(self, project_name):
+        return await self.proposer(project_name).cancel_project(project_name)
+
+    async def withdraw_pledge(self, pledge_id):
+        # Pledge ids don't name their project, so look for the group that has it
+        group = self.group_of_pledge(pledge_id)
+        if group == None:
+            # Pledged on another site and not applied here yet
+            await self.read_index()
+            group = self.group_of_pledge(pledge_id)
+        # The group re-checks after its own read and reports a pledge nobody has
+        return await self.proposers[group if group != None else min(self.proposers)].withdraw_pledge(pledge_id)
+
+    async def project_rows(self, count=None, after=None):
+        await self.read_index()
+        rows = []
+        for site in self.sites.values():
+            rows += site.project_rows(count, after)
+        return rows
+
+    async def projects(self, count=None, after=None):
+        return Outcome(True, project_lines(await self.project_rows(count, after), count))
+
+    async def list_out(self, project_name, offset=0, count=None):
+        group = group_of(project_name, self.total)
+        return Outcome(True, await self.proposers[group].read(self.sites[group].pledge_lines, project_name, offset, count))
+
+    def log(self, from_slot=None, to_slot=None):
+        # Every group has its own slots, the range applies to each of them
+        lines = []
+        for group in sorted(self.sites):
+            lines += self.sites[group].log_lines(from_slot, to_slot)
+        return Outcome(True, lines)
+
+    def debug(self):
+        for group in sorted(self.sites):
+            self.sites[group].debug()
+
+    def remove_log_entry(self, slot):
+        # Debug command, always on group 0
+        self.sites[0].remove_log_entry(slot)
+
+    def trace(self, last=None):
+        lines = []
+        for group in sorted(self.sites):
+            lines += self.sites[group].tracer.dump(last)
+        return lines
+
+    def set_trace_level(self, level):
+        for site in self.sites.values():
+            site.tracer.set_level(level)
+
+    def flush_traces(self):
+        for site in self.sites.values():
+            site.tracer.flush()
+
+    def report_stats(self):
+        self.metrics.report()
+
+    def dump_stats(self):
+        return self.metrics.dump()
+
+    def export_stats(self):
+        return self.metrics.export()
+
+    def close(self):
+        # Persist every group's apply point so the next start has nothing to replay
+        for site in self.sites.values():
+            site.write_snapshot()
+            site.tracer.close()
+
+class LocalShards():
+    # Blocking front for Shards, called from the input thread
+    def __init__(self, shards, runtime):
+        self.shards = shards
+        self.runtime = runtime
+
+    def __getattr__(self, name):
+        fn = getattr(self.shards, name)
+        return lambda *args: self.runtime.invoke(fn, *args)
+
+    def submit(self, name, *args):
+        # A Future of the user command's Outcome, without blocking
+        return self.runtime.invoke_async(getattr(self.shards, name), *args)
@@ -0,0 +1,294 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import selectors
+import shutil
+import tempfile
+import time
+from bench import make_workload, percentile
+from client import parse
+from consts import DEFAULT_CONFIG
+from metrics import Metrics
+from paxos_site import Site
+from runtime import Runtime, ClientProtocol
+from shards import Shards
+from wal import MemoryLog
+
+# Runs a whole cluster in one process on virtual time, over a simulated network with seeded delay, loss, reordering and partitions.
+# The same seed gives the same run. Proposer, Acceptor and Learner are the real ones, only the sockets, the clock and the WAL are not.
+# Example: python3 src/simulate.py --sites 101 --clients 5 --ops 20 --loss 0.01 --config '{"leader_mode": true}'
+
+EPHEMERAL_PORT = 49152 # First port handed to client endpoints, same as the OS would
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Deterministic in-process Paxos cluster simulator")
+    parser.add_argument("--sites", type=int, default=5, help="sites in the cluster")
+    parser.add_argument("--clients", type=int, default=None, help="sites that issue commands, defaults to all")
+    parser.add_argument("--ops", type=int, default=20, help="commands each client issues")
+    parser.add_argument("--projects", type=int, default=4, help="shared projects pledges go to")
+    parser.add_argument("--mix", default="pledge=6,withdraw=2,create=1,cancel=1", help="relative weight of each command")
+    parser.add_argument("--config", default="{}", help="JSON merged into the cluster config")
+    parser.add_argument("--script", action="store_true", help="each client's commands are in flight at once, like bench.py --script")
+    parser.add_argument("--delay-ms", type=float, default=1, help="one way delay of every datagram")
+    parser.add_argument("--jitter-ms", type=float, default=0.5, help="random extra delay on top, datagrams overtake each other by up to this much")
+    parser.add_argument("--loss", type=float, default=0, help="chance each datagram is lost")
+    parser.add_argument("--partition", default=None, help="AT_MS,HEAL_MS,COUNT: the last COUNT sites are cut off from the rest from AT_MS to HEAL_MS into the run")
+    parser.add_argument("--timeout", type=float, default=600, help="give up after this many simulated seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    return parser.parse_args()
+
+class VirtualSelector(selectors.DefaultSelector):
+    # Never blocks. With nothing ready, the time the loop would have waited for its next timer just passes.
+    def __init__(self, loop):
+        super().__init__()
+        self.loop = loop
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if not ready and timeout:
+            self.loop.now += timeout
+        return ready
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+    # Event loop on virtual time. Sleeps, timeouts and Runtime.now() all read it.
+    def __init__(self):
+        self.now = 0.0
+        super().__init__(VirtualSelector(self))
+
+    def time(self):
+        return self.now
+
+class SimTransport():
+    # What create_datagram_endpoint hands a protocol, bound to one address of the simulated network
+    def __init__(self, network, addr):
+        self.network = network
+        self.addr = addr
+
+    def sendto(self, data, addr):
+        self.network.transmit(data, self.addr, addr)
+
+    def close(self):
+        self.network.endpoints.pop(self.addr, None)
+
+class SimNetwork():
+    # Datagrams between simulated sites. Each one is delayed, may be lost, and never crosses a partition.
+    def __init__(self, loop, rng, delay, jitter, loss):
+        self.loop = loop
+        self.rng = rng
+        self.delay = delay
+        self.jitter = jitter
+        self.loss = loss
+        self.endpoints = {} # key: (ip_address, port). value: protocol bound there
+        self.ports = itertools.count(EPHEMERAL_PORT)
+        self.cut_off = set() # ip addresses on the far side of the partition
+        self.counters = {"sent": 0, "bytes": 0, "lost": 0, "partitioned": 0, "unreachable": 0}
+
+    def bind(self, protocol, ip_address, port):
+        addr = (ip_address, port or next(self.ports))
+        self.endpoints[addr] = protocol
+        return SimTransport(self, addr)
+
+    def partition(self, ip_addresses):
+        self.cut_off = set(ip_addresses)
+
+    def heal(self):
+        self.cut_off = set()
+
+    def transmit(self, data, src, dst):
+        self.counters["sent"] += 1
+        self.counters["bytes"] += len(data)
+        if (src[0] in self.cut_off) != (dst[0] in self.cut_off):
+            self.counters["partitioned"] += 1
+            return
+        if self.loss and self.rng.random() < self.loss:
+            self.counters["lost"] += 1
+            return
+        self.loop.call_later(self.delay + self.rng.uniform(0, self.jitter), self.arrive, data, src, dst)
+
+    def arrive(self, data, src, dst):
+        protocol = self.endpoints.get(dst)
+        if protocol == None:
+            self.counters["unreachable"] += 1
+            return
+        protocol.datagram_received(data, src)
+
+class SimRuntime(Runtime):
+    # Runtime of one simulated site. Every site shares the virtual loop, and its sockets are addresses on the simulated network.
+    def __init__(self, metrics, network, ip_address, wire_codec="binary"):
+        super().__init__(metrics, wire_codec, network.loop)
+        self.network = network
+        self.ip_address = ip_address
+
+    def start(self):
+        # No loop thread, the simulation drives the loop itself
+        self.transport = self.run(self.open_endpoint(lambda: ClientProtocol(self)))[0]
+
+    def run(self, coro):
+        # Only called while setting up, before the loop runs
+        return self.loop.run_until_complete(coro)
+
+    async def open_endpoint(self, protocol_factory, port=0):
+        protocol = protocol_factory()
+        transport = self.network.bind(protocol, self.ip_address, port)
+        protocol.connection_made(transport)
+        return transport, protocol
+
+def site_names(count):
+    return [f"site{i}" for i in range(count)]
+
+def make_hosts(names, groups):
+    # One address per site, so a partition can tell them apart. Same port ranges as bench.py.
+    ports = max(10, 4 * groups)
+    return {name: {"ip_address": f"10.0.{i // 250}.{i % 250 + 1}", "udp_start_port": 5000, "udp_end_port": 5000 + ports - 1} for i, name in enumerate(names)}
+
+async def run_client(shards, commands, script, results):
+    # Each command's (outcome, simulated ms), in the order they finish
+    loop = asyncio.get_running_loop()
+    inflight = []
+
+    async def timed(name, args):
+        start = loop.time()
+        outcome = await getattr(shards, name)(*args)
+        results.append((outcome, (loop.time() - start) * 1000))
+
+    for text in commands:
+        if text == "wait":
+            await asyncio.gather(*inflight)
+            inflight = []
+            continue
+        task = asyncio.ensure_future(timed(*parse(text)))
+        if script:
+            inflight.append(task)
+        else:
+            await task
+    await asyncio.gather(*inflight)
+
+def totals(cluster):
+    # Counters and hole fill rounds added up over every site
+    metrics = Metrics()
+    for shards in cluster:
+        metrics.merge(shards.metrics.export())
+    counters = dict(metrics.counters)
+    counters["fill_hole"] = metrics.histograms["fill_hole"].count
+    return counters
+
+def simulate(args):
+    clients = args.clients or args.sites
+    mix = {k: float(v) for k, v in (item.split("=") for item in args.mix.split(","))}
+    rng = random.Random(args.seed)
+    # Backoff jitter in the proposer draws from the module's generator
+    random.seed(args.seed)
+
+    loop = VirtualLoop()
+    asyncio.set_event_loop(loop)
+    network = SimNetwork(loop, random.Random(args.seed), args.delay_ms / 1000, args.jitter_ms / 1000, args.loss)
+    names = site_names(args.sites)
+    config = dict(DEFAULT_CONFIG)
+    config["trace_level"] = "off"
+    config.update(json.loads(args.config))
+    hosts = make_hosts(names, config["groups"])
+
+    cluster = []
+    for name in names:
+        site = Site(0, None, None, (name, hosts, dict(config)), MemoryLog)
+        runtime = SimRuntime(site.metrics, network, hosts[name]["ip_address"], config["wire_codec"])
+        runtime.start()
+        cluster.append(Shards(site, runtime))
+    loop.run_until_complete(asyncio.gather(*[shards.start() for shards in cluster]))
+
+    # Shared projects are created up front with a goal nobody will reach
+    setup = [f"create shared{i} {100 * 10**6}" for i in range(args.projects)]
+    loop.run_until_complete(run_client(cluster[0], setup, False, []))
+
+    workloads = [make_workload(args, i, names[i], rng, mix) for i in range(clients)]
+    if args.partition:
+        at, heal, count = args.partition.split(",")
+        loop.call_later(float(at) / 1000, network.partition, [hosts[name]["ip_address"] for name in names[-int(count):]])
+        loop.call_later(float(heal) / 1000, network.heal)
+
+    # Startup and setup traffic doesn't count
+    network_before = dict(network.counters)
+    counters_before = totals(cluster)
+    results = []
+    phase_start = loop.time()
+    wall_start = time.perf_counter()
+    clients_done = asyncio.gather(*[run_client(cluster[i], workloads[i], args.script, results) for i in range(clients)])
+    try:
+        loop.run_until_complete(asyncio.wait_for(clients_done, args.timeout))
+    except asyncio.TimeoutError:
+        pass
+    elapsed = loop.time() - phase_start
+    wall = time.perf_counter() - wall_start
+
+    # Lease renewals, batchers and pulls would go on forever
+    for task in asyncio.all_tasks(loop):
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(loop), return_exceptions=True))
+    loop.close()
+
+    network_counters = {k: v - network_before[k] for k, v in network.counters.items()}
+    counters = totals(cluster)
+    counters = {k: v - counters_before.get(k, 0) for k, v in counters.items()}
+    latencies = [ms for outcome, ms in results]
+    commits = sum(1 for outcome, ms in results if outcome.ok)
+    return {
+        "sites"              : args.sites,
+        "clients"            : clients,
+        "commands"           : sum(len([c for c in w if c != "wait"]) for w in workloads),
+        "finished"           : len(results),
+        "commits"            : commits,
+        "simulated_seconds"  : round(elapsed, 3),
+        "wall_seconds"       : round(wall, 3),
+        "commits_per_sec"    : round(commits / elapsed, 2) if elapsed else 0,
+        "p50_ms"             : round(percentile(latencies, 50), 2),
+        "p90_ms"             : round(percentile(latencies, 90), 2),
+        "p99_ms"             : round(percentile(latencies, 99), 2),
+        "max_ms"             : round(max(latencies, default=0), 2),
+        "messages_per_commit": round(network_counters["sent"] / commits, 2) if commits else 0,
+        "bytes_per_commit"   : round(network_counters["bytes"] / commits, 1) if commits else 0,
+        "network"            : network_counters,
+        "retries"            : counters.get("retries", 0),
+        "failed_proposals"   : counters.get("failed_proposals", 0),
+        "holes_pulled"       : counters.get("learner.pulled", 0),
+        "fill_hole_rounds"   : counters.get("fill_hole", 0),
+        "commit_retransmits" : counters.get("commit.retransmits", 0),
+        "config"             : json.loads(args.config)
+        }
+
+def main():
+    args = parse_args()
+    # Sites write their snapshots under logs/, in a directory of their own
+    directory = tempfile.mkdtemp(prefix="paxos-sim-")
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        os.makedirs("logs")
+        report = simulate(args)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.json:
+        print(json.dumps(report))
+        return
+    print(f"{report['sites']} sites, {report['clients']} clients, {report['commands']} commands, {report['finished']} finished in {report['simulated_seconds']} simulated s ({report['wall_seconds']} s wall)")
+    print(f"commits           {report['commits']}")
+    print(f"commits/sec       {report['commits_per_sec']}")
+    print(f"latency p50       {report['p50_ms']} ms")
+    print(f"latency p90       {report['p90_ms']} ms")
+    print(f"latency p99       {report['p99_ms']} ms")
+    print(f"latency max       {report['max_ms']} ms")
+    print(f"messages/commit   {report['messages_per_commit']}")
+    print(f"bytes/commit      {report['bytes_per_commit']}")
+    print(f"lost              {report['network']['lost']} lost, {report['network']['partitioned']} partitioned, {report['network']['unreachable']} unreachable")
+    print(f"retries           {report['retries']}")
+    print(f"failed proposals  {report['failed_proposals']}")
+    print(f"holes pulled      {report['holes_pulled']}")
+    print(f"fill_hole rounds  {report['fill_hole_rounds']}")
+    print(f"commit resends    {report['commit_retransmits']}")
+
+if __name__ == "__main__":
+    main()
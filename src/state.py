@@ -0,0 +1,161 @@
+import bisect
+from consts import UserAction
+
+class CrowdfundState():
+    # The replicated crowdfund state. Every lookup the learner and proposer make is a dict or set hit.
+    def __init__(self):
+        self.projects = {}           # key: project_name. value: funding_goal
+        self.pledges = {}            # key: project_name. value: {pledge_id: site_name}, in pledge order
+        self.pledge_project = {}     # key: pledge_id. value: project_name, for every live pledge
+        self.pledge_site = {}        # key: pledge_id. value: site_name, for every live pledge
+        self.ghost_pledged = {}      # key: project_name. value: {pledge_id: site_name} learned before the project
+        self.cancelled_projects = set()
+        self.cancelled_pledges = set()
+        # Kept up to date as actions are applied, so reads never walk every project
+        self.totals = {}             # key: project_name. value: amount pledged, 100 per pledge
+        self.index = []              # every project_name, sorted
+        self.pledge_order = {}       # key: project_name. value: [pledge_id, ...] in pledge order, withdrawn ones included until compacted
+        self.pledge_position = {}    # key: pledge_id. value: its place in its project's pledge_order, for every live pledge
+        self.withdrawn_at = {}       # key: project_name. value: places in pledge_order of withdrawn pledges, sorted
+
+    def apply(self, val):
+        # Returns whether the action changed the crowdfund state
+        action = val["action"]
+        if action == UserAction.CREATE_PROJECT:
+            return self.create_project(val["project_name"], val["funding_goal"])
+        elif action == UserAction.CANCEL_PROJECT:
+            return self.cancel_project(val["project_name"])
+        elif action == UserAction.CREATE_PLEDGE:
+            return self.create_pledge(val["pledge_id"], val["project_name"], val["site_name"])
+        elif action == UserAction.WITHDRAW_PLEDGE:
+            return self.withdraw_pledge(val["pledge_id"], val["project_name"])
+        return True
+
+    def create_project(self, project_name, funding_goal):
+        if project_name in self.cancelled_projects or project_name in self.projects:
+            return False
+        self.projects[project_name] = funding_goal
+        self.pledges[project_name] = self.ghost_pledged.pop(project_name, {})
+        self.totals[project_name] = len(self.pledges[project_name]) * 100
+        self.compact_order(project_name)
+        bisect.insort(self.index, project_name)
+        return True
+
+    def cancel_project(self, project_name):
+        self.cancelled_projects.add(project_name)
+        if project_name in self.projects:
+            del self.projects[project_name]
+            del self.totals[project_name]
+            del self.pledge_order[project_name]
+            del self.withdrawn_at[project_name]
+            del self.index[bisect.bisect_left(self.index, project_name)]
+            for pledge_id in self.pledges.pop(project_name):
+                self.pledge_project.pop(pledge_id, None)
+                self.pledge_site.pop(pledge_id, None)
+                self.pledge_position.pop(pledge_id, None)
+        return True
+
+    def create_pledge(self, pledge_id, project_name, site_name):
+        if pledge_id in self.cancelled_pledges:
+            return False
+        if project_name in self.projects:
+            if pledge_id not in self.pledges[project_name]:
+                self.totals[project_name] += 100
+                self.pledge_position[pledge_id] = len(self.pledge_order[project_name])
+                self.pledge_order[project_name].append(pledge_id)
+            self.pledges[project_name][pledge_id] = site_name
+            self.pledge_project[pledge_id] = project_name
+            self.pledge_site[pledge_id] = site_name
+        else:
+            # Pledge learned before the project it belongs to
+            self.ghost_pledged.setdefault(project_name, {})[pledge_id] = site_name
+        return True
+
+    def withdraw_pledge(self, pledge_id, project_name):
+        self.cancelled_pledges.add(pledge_id)
+        if project_name in self.projects:
+            if self.pledges[project_name].pop(pledge_id, None) != None:
+                self.totals[project_name] -= 100
+                bisect.insort(self.withdrawn_at[project_name], self.pledge_position.pop(pledge_id))
+                if len(self.withdrawn_at[project_name]) > len(self.pledges[project_name]):
+                    # Once more are withdrawn than live, so each withdrawal pays for its share of the rebuild
+                    self.compact_order(project_name)
+            self.pledge_project.pop(pledge_id, None)
+            self.pledge_site.pop(pledge_id, None)
+        elif project_name in self.ghost_pledged:
+            self.ghost_pledged[project_name].pop(pledge_id, None)
+        return True
+
+    def compact_order(self, project_name):
+        # The pledges dict is in pledge order already, the order list just makes a page a slice
+        self.pledge_order[project_name] = list(self.pledges[project_name])
+        self.withdrawn_at[project_name] = []
+        for position, pledge_id in enumerate(self.pledge_order[project_name]):
+            self.pledge_position[pledge_id] = position
+
+    def has_project(self, project_name):
+        return project_name in self.projects
+
+    def funding_goal(self, project_name):
+        return self.projects.get(project_name)
+
+    def list_pledges(self, project_name, offset=0, count=None):
+        # [[pledge_id, site_name], ...] in pledge order, or None for an unknown project. offset and count cut out one page.
+        if project_name not in self.pledges:
+            return None
+        pledges = self.pledges[project_name]
+        order = self.pledge_order[project_name]
+        withdrawn = self.withdrawn_at[project_name]
+        start = self.live_position(withdrawn, offset, len(order))
+        end = len(order) if count == None else self.live_position(withdrawn, offset + count, len(order))
+        return [[pledge_id, pledges[pledge_id]] for pledge_id in order[start:end] if pledge_id in pledges]
+
+    def live_position(self, withdrawn, live, size):
+        # Place in a pledge order of the live-th pledge not withdrawn, size if there are fewer
+        low, high = live, size
+        while low < high:
+            mid = (low + high) // 2
+            if mid + 1 - bisect.bisect_right(withdrawn, mid) > live:
+                high = mid
+            else:
+                low = mid + 1
+        return low
+
+    def project_names(self, after=None, count=None):
+        # Project names in order, starting after the name given
+        start = 0 if after == None else bisect.bisect_right(self.index, after)
+        return self.index[start:None if count == None else start + count]
+
+    def project_of(self, pledge_id):
+        return self.pledge_project.get(pledge_id)
+
+    def is_open(self, project_name):
+        # Pledges can still be added or withdrawn until the goal is reached
+        return self.totals[project_name] < self.projects[project_name]
+
+    def is_funded(self, project_name):
+        return self.totals[project_name] == self.projects[project_name]
+
+    def dump(self):
+        return {
+            "crowdfund"         : self.projects,
+            "pledges"           : self.pledges,
+            "cancelled_projects": sorted(self.cancelled_projects),
+            "cancelled_pledges" : sorted(self.cancelled_pledges),
+            "ghost_pledged"     : self.ghost_pledged
+            }
+
+    def load(self, snapshot):
+        self.__init__()
+        self.projects = snapshot["crowdfund"]
+        self.pledges = snapshot["pledges"]
+        self.cancelled_projects = set(snapshot["cancelled_projects"])
+        self.cancelled_pledges = set(snapshot["cancelled_pledges"])
+        self.ghost_pledged = snapshot["ghost_pledged"]
+        self.index = sorted(self.projects)
+        for project_name, pledges in self.pledges.items():
+            self.totals[project_name] = len(pledges) * 100
+            self.compact_order(project_name)
+            for pledge_id, site_name in pledges.items():
+                self.pledge_project[pledge_id] = project_name
+                self.pledge_site[pledge_id] = site_name
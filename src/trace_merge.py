@@ -0,0 +1,62 @@
+import argparse
+import sys
+from tracing import read_trace, format_record
+
+# Merges the trace files of several sites into one timeline per slot.
+# Example: python3 src/trace_merge.py logs/trace*.bin --slot 12
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge site trace files into a per-slot timeline")
+    parser.add_argument("files", nargs="+", help="trace files written with trace_file on")
+    parser.add_argument("--slot", type=int, action="append", help="only show this slot, may be repeated")
+    parser.add_argument("--from-slot", type=int, default=None, help="only show slots from this one onward")
+    parser.add_argument("--to-slot", type=int, default=None, help="only show slots below this one")
+    parser.add_argument("--unslotted", action="store_true", help="also show events that belong to no slot, such as leader changes")
+    return parser.parse_args()
+
+def merge(paths):
+    # Every event from every file as (site_name, record), in time order
+    events = []
+    for path in paths:
+        site_id, site_name, records = read_trace(path)
+        events += [(site_name, record) for record in records]
+    events.sort(key=lambda event: event[1][0])
+    return events
+
+def wanted(args, slot):
+    if args.slot and slot not in args.slot:
+        return False
+    if args.from_slot != None and slot < args.from_slot:
+        return False
+    if args.to_slot != None and slot >= args.to_slot:
+        return False
+    return True
+
+def main():
+    args = parse_args()
+    events = merge(args.files)
+    by_slot = {}
+    unslotted = []
+    for site_name, record in events:
+        slot = record[3]
+        if slot == None:
+            unslotted.append((site_name, record))
+        elif wanted(args, slot):
+            by_slot.setdefault(slot, []).append((site_name, record))
+
+    out = sys.stdout
+    if args.unslotted and unslotted:
+        out.write("no slot\n")
+        for site_name, record in unslotted:
+            out.write(f"  {format_record(site_name, record)}\n")
+    for slot in sorted(by_slot):
+        timeline = by_slot[slot]
+        first = timeline[0][1][0]
+        out.write(f"slot {slot}\n")
+        for site_name, record in timeline:
+            # Offsets are only as good as the clocks of the sites involved
+            offset = (record[0] - first) * 1000
+            out.write(f"  +{offset:9.3f} ms {format_record(site_name, record, show_time=False)}\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import os
+import struct
+import time
+from collections import deque
+from codec import ballot_round, ballot_site, write_str, read_str, write_value, read_value
+
+# A tracer keeps every event at or below its level
+OFF, INFO, DEBUG = range(3)
+LEVELS = {"off": OFF, "info": INFO, "debug": DEBUG}
+LEVEL_NAMES = {level: name for name, level in LEVELS.items()}
+
+# Trace files are a header with the site, then <record length><time, level, name, slot, ballot, fields> per event
+MAGIC = b"PXTR"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sBH") # magic, version, site_id
+RECORD_LEN = struct.Struct("<I")
+
+class Tracer():
+    # Structured protocol events. An event is stored as a tuple holding references to its values,
+    # nothing gets formatted until the ring is dumped or a trace file is read back.
+    # Only touched from the site's event loop.
+    def __init__(self, site_id, site_name, level="info", ring_size=4096, path=None):
+        self.site_id = site_id
+        self.site_name = site_name
+        self.level = LEVELS[level]
+        self.ring = deque(maxlen=ring_size)
+        self.file = None
+        if path:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.file = open(path, "ab", buffering=1 << 16)
+            if self.file.tell() == 0:
+                header = bytearray(FILE_HEADER.pack(MAGIC, VERSION, site_id))
+                write_str(header, site_name)
+                self.file.write(header)
+
+    def event(self, level, name, slot=None, num=None, **fields):
+        if level > self.level:
+            return
+        record = (time.time(), level, name, slot, num, fields)
+        self.ring.append(record)
+        if self.file:
+            body = bytearray()
+            write_value(body, record)
+            self.file.write(RECORD_LEN.pack(len(body)))
+            self.file.write(body)
+
+    def info(self, name, slot=None, num=None, **fields):
+        self.event(INFO, name, slot, num, **fields)
+
+    def debug(self, name, slot=None, num=None, **fields):
+        self.event(DEBUG, name, slot, num, **fields)
+
+    def set_level(self, level):
+        self.level = LEVELS[level]
+
+    def dump(self, last=None):
+        # Formatted ring, oldest first
+        records = list(self.ring)[-last:] if last else self.ring
+        return [format_record(self.site_name, record) for record in records]
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+
+def format_ballot(num):
+    return f"{ballot_round(num)}.{ballot_site(num)}"
+
+def format_record(site_name, record, show_time=True):
+    t, level, name, slot, num, fields = record
+    parts = [f"{t:.6f}"] if show_time else []
+    parts += [site_name, LEVEL_NAMES[level], name]
+    if slot != None:
+        parts.append(f"slot={slot}")
+    if num != None:
+        parts.append(f"ballot={format_ballot(num)}")
+    parts += [f"{key}={value}" for key, value in fields.items()]
+    return " ".join(parts)
+
+def read_trace(path):
+    # Returns (site_id, site_name, records). A torn last record is left out.
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, version, site_id = FILE_HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"{path} is not a version {VERSION} trace file")
+    site_name, offset = read_str(data, FILE_HEADER.size)
+    records = []
+    while offset + RECORD_LEN.size <= len(data):
+        length, = RECORD_LEN.unpack_from(data, offset)
+        offset += RECORD_LEN.size
+        if offset + length > len(data):
+            break
+        record, _ = read_value(data, offset)
+        records.append(tuple(record))
+        offset += length
+    return site_id, site_name, records
@@ -0,0 +1,169 @@
+import logging
+import os
+import json
+import struct
+import threading
+import time
+import zlib
+
+# Every record is <payload length><crc32 of payload><json payload>
+HEADER = struct.Struct("<II")
+
+class WriteAheadLog():
+    def __init__(self, directory, segment_bytes, group_commit_ms):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.group_commit_delay = group_commit_ms / 1000
+        os.makedirs(self.directory, exist_ok=True)
+
+        self.cond = threading.Condition()
+        self.lsn = 0         # Sequence number of the last appended record
+        self.durable_lsn = 0 # Sequence number of the last fsynced record
+        self.callbacks = [] # (lsn, callback) to run once lsn is durable
+        self.rolled = [] # Full segments the flusher still has to fsync and close
+        self.file = None
+        self.segment = None
+        self.segment_size = 0
+
+    def segments(self):
+        return sorted(int(name.split(".")[0]) for name in os.listdir(self.directory) if name.endswith(".wal"))
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.wal")
+
+    def replay(self):
+        # Yields every intact record in order. A torn or corrupt tail is cut off so appends continue after it.
+        segments = self.segments()
+        for i, segment in enumerate(segments):
+            path = self.segment_path(segment)
+            with open(path, "rb") as f:
+                data = f.read()
+            offset = 0
+            while offset < len(data):
+                if offset + HEADER.size > len(data):
+                    break
+                length, crc = HEADER.unpack_from(data, offset)
+                payload = data[offset + HEADER.size:offset + HEADER.size + length]
+                if len(payload) != length or zlib.crc32(payload) != crc:
+                    break
+                yield json.loads(payload.decode("utf-8"))
+                offset += HEADER.size + length
+            if offset < len(data):
+                logging.info(f"WAL: Dropping {len(data) - offset} bytes of torn records in {path}")
+                with open(path, "r+b") as f:
+                    f.truncate(offset)
+                # Nothing after a broken record can be trusted
+                for later in segments[i + 1:]:
+                    os.remove(self.segment_path(later))
+                return
+
+    def open(self):
+        segments = self.segments()
+        self.segment = segments[-1] if segments else 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.segment_size = self.file.tell()
+        flusher = threading.Thread(target=self.flusher)
+        flusher.daemon = True
+        flusher.start()
+
+    def roll(self):
+        # Called with self.cond held. The flusher fsyncs and closes the full segment, appends go on to the new one.
+        self.file.flush()
+        self.rolled.append(self.file)
+        self.segment += 1
+        self.file = open(self.segment_path(self.segment), "ab")
+        self.segment_size = 0
+
+    def checkpoint(self):
+        # Starts a new segment and returns it. Older segments can go once a snapshot covers them.
+        with self.cond:
+            self.roll()
+            return self.segment
+
+    def drop_before(self, segment):
+        for old in self.segments():
+            if old < segment:
+                os.remove(self.segment_path(old))
+
+    def append(self, record, sync=True):
+        payload = json.dumps(record).encode("utf-8")
+        with self.cond:
+            if self.segment_size and self.segment_size + HEADER.size + len(payload) > self.segment_bytes:
+                self.roll()
+            self.file.write(HEADER.pack(len(payload), zlib.crc32(payload)))
+            self.file.write(payload)
+            self.segment_size += HEADER.size + len(payload)
+            self.lsn += 1
+            lsn = self.lsn
+            self.cond.notify_all()
+            if sync:
+                while self.durable_lsn < lsn:
+                    self.cond.wait()
+        return lsn
+
+    def when_durable(self, lsn, callback):
+        with self.cond:
+            if self.durable_lsn < lsn:
+                self.callbacks.append((lsn, callback))
+                return
+        callback()
+
+    def pop_ready(self):
+        # Called with self.cond held
+        ready = [cb for lsn, cb in self.callbacks if lsn <= self.durable_lsn]
+        self.callbacks = [(lsn, cb) for lsn, cb in self.callbacks if lsn > self.durable_lsn]
+        return ready
+
+    def flusher(self):
+        # Group commit: one fsync covers every record appended while the previous one was in progress
+        while True:
+            with self.cond:
+                while self.durable_lsn == self.lsn:
+                    self.cond.wait()
+            time.sleep(self.group_commit_delay)
+            with self.cond:
+                target = self.lsn
+                self.file.flush()
+                files = self.rolled + [self.file]
+                self.rolled = []
+            # Without the lock, so appends carry on while the disk catches up. Only the flusher closes segments.
+            for f in files:
+                os.fsync(f.fileno())
+            for f in files[:-1]:
+                f.close()
+            with self.cond:
+                self.durable_lsn = max(self.durable_lsn, target)
+                self.cond.notify_all()
+                ready = self.pop_ready()
+            for callback in ready:
+                callback()
+
+class MemoryLog():
+    # Same interface as WriteAheadLog for sites that never restart, like the simulator's.
+    # Appends are durable right away and nothing is kept.
+    def __init__(self, directory, segment_bytes, group_commit_ms):
+        self.lsn = 0
+        self.durable_lsn = 0
+
+    def segments(self):
+        return []
+
+    def replay(self):
+        return iter(())
+
+    def open(self):
+        pass
+
+    def checkpoint(self):
+        return self.lsn
+
+    def drop_before(self, segment):
+        pass
+
+    def append(self, record, sync=True):
+        self.lsn += 1
+        self.durable_lsn = self.lsn
+        return self.lsn
+
+    def when_durable(self, lsn, callback):
+        callback()
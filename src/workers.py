@@ -0,0 +1,254 @@
+import logging, sys
+import concurrent.futures
+import multiprocessing
+import threading
+from metrics import Metrics
+from paxos_site import Site
+from proposer import Outcome
+from runtime import Runtime
+from shards import Shards, group_of, project_lines
+
+class SharedCounters():
+    # Pledge and proposal counters in shared memory, so the workers of a site never hand out the same pledge id
+    NAMES = ["pledge", "proposal"]
+
+    def __init__(self, ctx):
+        self.values = ctx.Array("q", [1, 0])
+
+    def __getitem__(self, name):
+        return self.values[self.NAMES.index(name)]
+
+    def __setitem__(self, name, value):
+        # Counters only grow. A worker loading an older value from its own WAL leaves a later one alone.
+        i = self.NAMES.index(name)
+        with self.values.get_lock():
+            self.values[i] = max(self.values[i], value)
+
+    def take(self, name):
+        # Hands out the current value and moves the counter on, atomically across workers
+        i = self.NAMES.index(name)
+        with self.values.get_lock():
+            value = self.values[i]
+            self.values[i] = value + 1
+        return value
+
+def then(future, fn):
+    # Future of fn(result of future). fn may return a Future, whose result is then the one passed on.
+    # fn runs on whichever thread finishes future, so it must not block.
+    chained = concurrent.futures.Future()
+    def step(done):
+        try:
+            res = fn(done.result())
+        except Exception as e:
+            chained.set_exception(e)
+            return
+        if isinstance(res, concurrent.futures.Future):
+            res.add_done_callback(lambda inner: pass_on(inner, chained))
+        else:
+            chained.set_result(res)
+    future.add_done_callback(step)
+    return chained
+
+def pass_on(done, future):
+    try:
+        future.set_result(done.result())
+    except Exception as e:
+        future.set_exception(e)
+
+def gather(futures):
+    # Future of the results of every one of futures, in order
+    gathered = concurrent.futures.Future()
+    results = [None] * len(futures)
+    left = [len(futures)]
+    lock = threading.Lock()
+    def step(i, done):
+        try:
+            results[i] = done.result()
+        except Exception as e:
+            if not gathered.done():
+                gathered.set_exception(e)
+            return
+        with lock:
+            left[0] -= 1
+            last = left[0] == 0
+        if last:
+            gathered.set_result(results)
+    for i, future in enumerate(futures):
+        future.add_done_callback(lambda done, i=i: step(i, done))
+    if not futures:
+        gathered.set_result(results)
+    return gathered
+
+def run_worker(groups, counters, conn):
+    # Entry point of a worker process: the Paxos groups it was given, on its own event loop and its own GIL
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG)
+    site = Site(groups[0], counters)
+    runtime = Runtime(site.metrics, site.config["wire_codec"])
+    runtime.start()
+    shards = Shards(site, runtime, groups)
+    runtime.run(shards.start())
+    conn.send(None) # Ready
+    send_lock = threading.Lock() # Replies are sent from the loop thread, close's from this one
+
+    def finish(req_id, name, future):
+        try:
+            res = future.result()
+        except Exception as e:
+            logging.info(f"Worker: {name} failed, {e}")
+            res = None
+        # Whatever the command printed has to be out before the main process sees it is done
+        sys.stdout.flush()
+        with send_lock:
+            conn.send((req_id, res))
+
+    while True:
+        try:
+            req_id, name, args = conn.recv()
+        except EOFError:
+            break
+        # Calls run concurrently on the loop and reply as they finish, a slow proposal holds up nobody else
+        future = runtime.invoke_async(getattr(shards, name), *args)
+        if name == "close":
+            finish(req_id, name, future)
+            break
+        future.add_done_callback(lambda future, req_id=req_id, name=name: finish(req_id, name, future))
+
+class Worker():
+    def __init__(self, ctx, groups, counters):
+        self.groups = groups
+        self.conn, child_conn = ctx.Pipe()
+        self.lock = threading.Lock() # Client threads and the stats endpoint share the pipe
+        self.futures = {} # key: request id. value: Future for the worker's reply
+        self.next_id = 0
+        self.process = ctx.Process(target=run_worker, args=(groups, counters, child_conn))
+        self.process.start()
+
+    def start(self):
+        self.conn.recv() # Ready
+        reader = threading.Thread(target=self.read_replies)
+        reader.daemon = True
+        reader.start()
+
+    def read_replies(self):
+        # Replies come back in the order calls finish, the request id says whose each one is
+        while True:
+            try:
+                req_id, res = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            self.futures.pop(req_id).set_result(res)
+        # Worker is gone, nobody will answer the rest
+        for req_id in list(self.futures):
+            self.futures.pop(req_id).set_result(None)
+
+    def call_async(self, name, *args):
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.next_id += 1
+            self.futures[self.next_id] = future
+            self.conn.send((self.next_id, name, args))
+        return future
+
+    def call(self, name, *args):
+        return self.call_async(name, *args).result()
+
+class Workers():
+    # The site's Paxos groups spread over worker processes, group g runs in worker g % processes.
+    # Same methods as LocalShards, each one forwarded over a pipe to the workers that have the groups involved.
+    # User commands go through submit and chain the workers' replies, no thread waits on them.
+    # Peers can't tell the difference, every group keeps its ports and wire protocol.
+    def __init__(self, config):
+        ctx = multiprocessing.get_context("spawn")
+        self.groups = config["groups"]
+        if config["processes"] > self.groups:
+            # A worker with no group would sit idle
+            raise Exception(f"processes is {config['processes']} but there are only {self.groups} groups, raise groups or lower processes")
+        count = config["processes"]
+        counters = SharedCounters(ctx)
+        self.workers = [Worker(ctx, list(range(i, self.groups, count)), counters) for i in range(count)]
+        for worker in self.workers:
+            worker.start()
+
+    def worker(self, group):
+        return self.workers[group % len(self.workers)]
+
+    def for_project(self, project_name):
+        return self.worker(group_of(project_name, self.groups))
+
+    def call_all_async(self, name, *args):
+        # Every worker runs the call at the same time
+        return gather([worker.call_async(name, *args) for worker in self.workers])
+
+    def call_all(self, name, *args):
+        return self.call_all_async(name, *args).result()
+
+    def submit(self, name, *args):
+        return getattr(self, name)(*args)
+
+    # User commands return a Future of an Outcome, of None if the worker failed
+    def create_project(self, project_name, funding_goal):
+        return self.for_project(project_name).call_async("create_project", project_name, funding_goal)
+
+    def create_pledge(self, project_name, user_id):
+        return self.for_project(project_name).call_async("create_pledge", project_name, user_id)
+
+    def cancel_project(self, project_name):
+        return self.for_project(project_name).call_async("cancel_project", project_name)
+
+    def withdraw_pledge(self, pledge_id):
+        def owners(groups):
+            return [group for group in groups if group != None]
+        def withdraw(owners):
+            return self.worker(owners[0] if owners else 0).call_async("withdraw_pledge", pledge_id)
+        def found(first):
+            if first:
+                return withdraw(first)
+            # Pledged on another site and not applied here yet
+            read = then(self.call_all_async("read_index"), lambda _: self.call_all_async("group_of_pledge", pledge_id))
+            return then(then(read, owners), withdraw)
+        return then(then(self.call_all_async("group_of_pledge", pledge_id), owners), found)
+
+    def projects(self, count=None, after=None):
+        return then(self.call_all_async("project_rows", count, after), lambda all_rows: Outcome(True, project_lines([row for rows in all_rows for row in rows], count)))
+
+    def list_out(self, project_name, offset=0, count=None):
+        return self.for_project(project_name).call_async("list_out", project_name, offset, count)
+
+    def log(self, from_slot=None, to_slot=None):
+        return then(self.call_all_async("log", from_slot, to_slot), lambda outcomes: Outcome(True, [line for outcome in outcomes for line in outcome.lines]))
+
+    def debug(self):
+        for worker in self.workers:
+            worker.call("debug")
+
+    def remove_log_entry(self, slot):
+        self.worker(0).call("remove_log_entry", slot)
+
+    def trace(self, last=None):
+        lines = []
+        for worker_lines in self.call_all("trace", last):
+            lines += worker_lines
+        return lines
+
+    def set_trace_level(self, level):
+        self.call_all("set_trace_level", level)
+
+    def flush_traces(self):
+        self.call_all("flush_traces")
+
+    def metrics(self):
+        metrics = Metrics()
+        for exported in self.call_all("export_stats"):
+            metrics.merge(exported)
+        return metrics
+
+    def report_stats(self):
+        self.metrics().report()
+
+    def dump_stats(self):
+        return self.metrics().dump()
+
+    def close(self):
+        self.call_all("close")
+        for worker in self.workers:
+            worker.process.join()